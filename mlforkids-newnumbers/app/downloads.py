@@ -0,0 +1,85 @@
+# core dependencies
+from os import stat
+from os.path import exists
+from pathlib import Path
+from mimetypes import guess_type
+from re import compile
+# external dependencies
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+# local dependencies
+from app.utils import compressed_copies
+
+
+# names of the folders for each version of a model
+version_pattern = compile("v[0-9a-f]{32}")
+
+# files in a versioned folder never change, so they can be
+#  cached by clients for as long as they like
+immutable_cache = "public, max-age=31536000, immutable"
+# other files can be cached, but clients should check that
+#  they haven't changed before using them
+revalidate_cache = "no-cache"
+
+
+def is_version(name: str) -> bool:
+    return version_pattern.fullmatch(name) is not None
+
+
+# returns the content codings that a client will accept
+def get_accepted_encodings(acceptencoding: str):
+    accepted = set()
+    for coding in (acceptencoding or "").split(","):
+        name, _, parameters = coding.partition(";")
+        parameters = parameters.replace(" ", "")
+        if parameters.startswith("q=") and parameters[2:].strip("0.") == "":
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+# serves model files, choosing a precompressed copy of the file
+#  if the client accepts it
+#  files for a model version are given ETags based on the
+#   version, as they are only ever written once
+class ModelFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        requested = scope["path"].split("/")
+        served = Path(full_path)
+        headers = { "Vary": "Accept-Encoding" }
+
+        encoding = None
+        accepted = get_accepted_encodings(request_headers.get("accept-encoding"))
+        for extension, coding in compressed_copies:
+            compressed_path = str(served) + extension
+            if coding in accepted and exists(compressed_path):
+                encoding = coding
+                full_path = compressed_path
+                stat_result = stat(compressed_path)
+                headers["Content-Encoding"] = coding
+                break
+
+        version = served.parent.name
+        if is_version(version):
+            etag = version + "-" + served.name
+            if encoding is not None:
+                etag += "-" + encoding
+            headers["ETag"] = '"' + etag + '"'
+            if version in requested:
+                headers["Cache-Control"] = immutable_cache
+            else:
+                headers["Cache-Control"] = revalidate_cache
+        else:
+            headers["Cache-Control"] = revalidate_cache
+
+        response = FileResponse(full_path,
+                                status_code=status_code,
+                                headers=headers,
+                                media_type=guess_type(served.name)[0],
+                                stat_result=stat_result)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,104 @@
+# core dependencies
+from logging import info, exception
+from os import getenv, SEEK_END
+from csv import reader
+from typing import BinaryIO
+# external dependencies
+from fastapi import HTTPException, status
+from pandas import DataFrame, read_csv, concat, unique
+from pandas.api.types import is_numeric_dtype
+
+
+# limits on the size of CSV files that will be accepted
+maxbytes = int(getenv("CSV_MAX_BYTES", str(10 * 1024 * 1024)))
+maxrows = int(getenv("CSV_MAX_ROWS", "100000"))
+maxcolumns = int(getenv("CSV_MAX_COLUMNS", "250"))
+# number of rows parsed at a time
+chunkrows = int(getenv("CSV_CHUNK_ROWS", "10000"))
+info("Accepting CSV files up to %d bytes, %d rows, %d columns", maxbytes, maxrows, maxcolumns)
+
+outcome_label = "mlforkids_outcome_label"
+
+
+def invalid_csv(detail: str, status_code=status.HTTP_400_BAD_REQUEST):
+    return HTTPException(status_code=status_code, detail=detail)
+
+
+# checks the column names in the first line of the file
+#  before any of the training examples are parsed
+def read_header(scratchkey: str, csvfile: BinaryIO):
+    try:
+        headerline = csvfile.readline(maxbytes).decode("utf-8-sig")
+        header = next(reader([ headerline ]))
+    except:
+        exception("Failed to parse CSV header for %s", scratchkey)
+        raise invalid_csv("Unable to process CSV file")
+
+    # check that the CSV contains the expected outcome column
+    if outcome_label not in header:
+        raise invalid_csv("Invalid CSV file")
+    if len(header) > maxcolumns:
+        raise invalid_csv("CSV file has too many columns",
+                          status.HTTP_413_CONTENT_TOO_LARGE)
+    return header
+
+
+# parses the training examples a chunk at a time, so that
+#  files with too many rows are rejected without needing to
+#  hold all of them in memory
+def read_rows(scratchkey: str, csvfile: BinaryIO):
+    chunks = []
+    numrows = 0
+    try:
+        for chunk in read_csv(csvfile, chunksize=chunkrows):
+            numrows += len(chunk)
+            if numrows > maxrows:
+                raise invalid_csv("CSV file has too many rows",
+                                  status.HTTP_413_CONTENT_TOO_LARGE)
+            chunks.append(chunk)
+    except HTTPException:
+        raise
+    except:
+        exception("Failed to parse CSV for %s", scratchkey)
+        raise invalid_csv("Unable to process CSV file")
+
+    if len(chunks) == 1:
+        return chunks[0]
+
+    dataframe = concat(chunks, ignore_index=True)
+
+    # a column that looked numeric in one chunk but not in
+    #  another would be left with a mix of numbers and strings
+    #  so parse the file again to get consistent types
+    for column in dataframe.columns:
+        dtypes = set(chunk[column].dtype for chunk in chunks)
+        if len(dtypes) > 1 and not all(is_numeric_dtype(dtype) for dtype in dtypes):
+            info("%s : Inconsistent types for column in CSV, re-reading", scratchkey)
+            del chunks, dataframe
+            csvfile.seek(0)
+            return read_csv(csvfile)
+
+    return dataframe
+
+
+# reads a CSV file of training data into a dataframe
+#  raises an HTTP exception if the file is unusable
+#  intended to be run in a thread, not on the event loop
+def read_training_data(scratchkey: str, csvfile: BinaryIO) -> DataFrame:
+    csvfile.seek(0, SEEK_END)
+    if csvfile.tell() > maxbytes:
+        raise invalid_csv("CSV file is too large",
+                          status.HTTP_413_CONTENT_TOO_LARGE)
+    csvfile.seek(0)
+
+    read_header(scratchkey, csvfile)
+    csvfile.seek(0)
+    dataframe = read_rows(scratchkey, csvfile)
+
+    # check that there are training examples for multiple classes
+    #  otherwise model training will fail
+    numclasses = len(unique(dataframe[outcome_label]))
+    if numclasses < 2:
+        raise invalid_csv("Examples needed for at least two classes to train a model")
+
+    return dataframe
@@ -1,12 +1,16 @@
 # core dependencies
 from logging import info, exception, basicConfig
 from os import getenv
+from os.path import join, exists, basename, realpath
+from contextlib import asynccontextmanager
+from asyncio import wait_for, shield
+from time import monotonic, perf_counter
 # external dependencies
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, BackgroundTasks
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, Request
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse, FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from pandas import read_csv, unique
+from fastapi.concurrency import run_in_threadpool
 
 # debug logging
 if getenv("MODE") == "development":
@@ -14,16 +18,43 @@ if getenv("MODE") == "development":
     print("Logging to file mlforkids.log")
 
 # local dependencies
-from app.savedmodels import create
-from app.models import train_model
+#  modules that need the ML libraries are loaded after the
+#  server starts, and are used through app.mlstack
+from app.startup import start_warmup, stop_warmup, wait_for_warmup, get_mlstack
+from app.startup import state as startup_state
+from app.savedmodels import create, record_job, load_saved_models
+from app.savedmodels import saved_models_cache, get_location, read_status_files
+from app.savedmodels import get_visualisation_data_location, read_status_file
+from app.statusupdates import serialize_status, wait_for_status_change, maxwait, keepalive, maxkeys
+from app.payloads import StatusRequest
+from app.downloads import ModelFiles, is_version
+from app.trash import start_collector, stop_collector, stats as trash_stats
+from app.metrics import observe, increment, set_value, render_metrics
+from app.profiling import read_profiles, get_profile_location, profile_names
+from app.utils import folder_size
 from app.auth import validate_password
 
 
 
 
+# start and stop the processes used to train models, and
+#  the thread used to delete old models, alongside the API
+#  server
+#  the training processes are started in the background, so
+#   the server can respond to healthchecks while it starts
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_saved_models()
+    start_collector()
+    start_warmup()
+    yield
+    stop_warmup()
+    stop_collector()
+
+
 # prepare API server
 info("Preparing API server")
-app = FastAPI(openapi_url=None)
+app = FastAPI(openapi_url=None, lifespan=lifespan)
 security = HTTPBasic()
 app.add_middleware(
     CORSMiddleware,
@@ -33,23 +64,159 @@ app.add_middleware(
     ]
 )
 
+# records how long each request takes to respond to
+#  requests are identified by the route that handled them,
+#  rather than the URL, so that each project isn't counted
+#  separately
+#  requests for static files are identified by the path
+#   where the files are mounted
+def get_route_label(scope: dict):
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    return scope.get("root_path") or "unknown"
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    request_start = perf_counter()
+    response = await call_next(request)
+    observe("mlforkids_http_request_duration_seconds", perf_counter() - request_start, {
+        "method": request.method,
+        "route": get_route_label(request.scope),
+        "status": response.status_code
+    })
+    return response
+
+
 # healthcheck endpoint for use by kubernetes probes
 @app.get("/")
 def healthcheck():
-    return { "ok" : True }
+    ml = get_mlstack()
+    if ml is None:
+        return { "ok" : True, "startup" : startup_state }
+    return { "ok" : True, "startup" : startup_state, "memory" : ml.get_memory_stats() }
+
+
+# liveness endpoint for use by kubernetes probes
+#  the server is live while it is starting, unless it has
+#  failed to load the ML libraries, as restarting it is the
+#  only way to recover from that
+@app.get("/live")
+def liveness():
+    if startup_state["status"] == "Failed":
+        return JSONResponse({ "live" : False, "startup" : startup_state },
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return { "live" : True }
+
+
+# readiness endpoint for use by kubernetes probes
+#  the server is ready once the ML libraries are loaded and
+#  the training processes have been warmed up
+@app.get("/ready")
+def readiness():
+    ml = get_mlstack()
+    if ml is None:
+        return JSONResponse({ "ready" : False, "startup" : startup_state },
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return { "ready" : True, "startup" : startup_state, "queue" : ml.get_queue_stats() }
+
+
+# folders with files created by the server
+disk_folders = [ "saved-models", "working-files", "model-store", "trash" ]
+
+def get_disk_usage():
+    return { folder: folder_size(folder) for folder in disk_folders }
+
+# metrics endpoint for use by Prometheus
+@app.get("/metrics")
+async def metrics():
+    ml = get_mlstack()
+    if ml is not None:
+        memory = ml.get_memory_stats()
+        queue = ml.get_queue_stats()
+        set_value("mlforkids_startup_seconds", startup_state["seconds"])
+        set_value("mlforkids_training_jobs_inflight", queue["submitted"])
+        set_value("mlforkids_training_jobs_running", queue["training"])
+        set_value("mlforkids_training_jobs_waiting", queue["waiting"])
+        set_value("mlforkids_training_memory_reserved_bytes", memory["reserved"])
+        set_value("mlforkids_models_stored", len(ml.stored_models))
+    set_value("mlforkids_models_cached", len(saved_models_cache))
+    for folder, size in (await run_in_threadpool(get_disk_usage)).items():
+        set_value("mlforkids_disk_bytes", size, { "folder": folder })
+    set_value("mlforkids_trash_pending_items", trash_stats["pendingitems"])
+    set_value("mlforkids_trash_pending_bytes", trash_stats["pendingbytes"])
+    set_value("mlforkids_trash_collected_bytes_total", trash_stats["collectedbytes"])
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 # hosting created decision tree models as static files
-app.mount("/saved-models", StaticFiles(directory="saved-models"), name="static")
+model_files = ModelFiles(directory="saved-models")
 
+# seconds that clients are asked to wait before retrying
+#  requests for a visualisation that is still being created
+visualisationretry = getenv("VISUALISATION_RETRY_AFTER", "10")
 
-# handle requests to train new models
-@app.post("/model-requests/{scratch_key}")
-async def model_training_request(scratch_key: str, csvfile: UploadFile,
-                                 background_tasks: BackgroundTasks,
-                                 credentials: HTTPBasicCredentials = Depends(security)):
 
-    # check credentials before proceeding
+# visualisations of models are created the first time
+#  that they are requested, rather than while training
+#  files can be requested from the download folder for the
+#   latest version of a model, or from a versioned folder
+async def get_visualisation_file(request: Request, scratch_key: str, folder: str, filename: str):
+    if folder != "download" and not is_version(folder):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    model_folder = get_location(scratch_key)
+    file_location = join(model_folder, folder, filename)
+    if not exists(file_location):
+        modelinfo = saved_models_cache.get(scratch_key)
+        if modelinfo is None or modelinfo["status"] != "Available":
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+        # visualisations are only created for the latest version
+        if folder != "download" and basename(realpath(join(model_folder, "download"))) != folder:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+        # the data needed to create a visualisation isn't kept
+        #  for models trained with too much data
+        if not exists(get_visualisation_data_location(scratch_key)):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+        info("%s : Creating visualisation on request", scratch_key)
+        ml = await wait_for_warmup()
+        try:
+            # the job is shared with other requests for the same
+            #  visualisation, so it isn't cancelled if this
+            #  request stops waiting
+            await wait_for(shield(ml.submit_visualisation(scratch_key)), timeout=ml.visualisationwait)
+        except TimeoutError:
+            info("%s : Visualisation is still being created. Rejecting request", scratch_key)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="The visualisation is being created. Please try again later",
+                headers={"Retry-After": visualisationretry}
+            )
+        except:
+            exception("%s : Failed to create visualisation", scratch_key)
+        if not exists(file_location):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return await model_files.get_response(join(scratch_key, folder, filename), request.scope)
+
+@app.api_route("/saved-models/{scratch_key}/{folder}/tree.svg", methods=["GET", "HEAD"])
+async def get_visualisation_tree(request: Request, scratch_key: str, folder: str):
+    return await get_visualisation_file(request, scratch_key, folder, "tree.svg")
+
+@app.api_route("/saved-models/{scratch_key}/{folder}/tree.dot", methods=["GET", "HEAD"])
+async def get_visualisation_dot(request: Request, scratch_key: str, folder: str):
+    return await get_visualisation_file(request, scratch_key, folder, "tree.dot")
+
+@app.api_route("/saved-models/{scratch_key}/{folder}/vocab.json", methods=["GET", "HEAD"])
+async def get_visualisation_vocab(request: Request, scratch_key: str, folder: str):
+    return await get_visualisation_file(request, scratch_key, folder, "vocab.json")
+
+
+app.mount("/saved-models", model_files, name="static")
+
+
+# rejects requests that aren't from the main API
+def check_credentials(credentials: HTTPBasicCredentials):
     if not validate_password(credentials):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -57,44 +224,214 @@ async def model_training_request(scratch_key: str, csvfile: UploadFile,
             headers={"WWW-Authenticate": "Basic"},
         )
 
+
+# handle requests to train new models
+@app.post("/model-requests/{scratch_key}")
+async def model_training_request(scratch_key: str, csvfile: UploadFile,
+                                 credentials: HTTPBasicCredentials = Depends(security)):
+
+    # check credentials before proceeding
+    check_credentials(credentials)
+
+    # wait for the ML libraries if the server is starting
+    ml = await wait_for_warmup()
+
     # credentials okay - check we have been given a
     #  usable CSV file before letting the user think
     #  that training will be attempted
+    #  a newer request for the same project while the file
+    #   is being read replaces this request
     info("%s : New training request", scratch_key)
+    request = ml.start_request(scratch_key)
     try:
-        # read the CSV file into a pandas dataframe
-        df = read_csv(csvfile.file)
-    except:
-        exception("Failed to parse CSV for %s", scratch_key)
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Unable to process CSV file"
-        )
+        parse_start = perf_counter()
+        df = await run_in_threadpool(ml.read_training_data, scratch_key, csvfile.file)
+        observe("mlforkids_csv_parse_seconds", perf_counter() - parse_start)
+        fingerprint = await run_in_threadpool(ml.get_fingerprint, df, ml.get_learner_options(df))
+        datasize = await run_in_threadpool(ml.get_data_size, df)
 
-    # check that the CSV contains the expected outcome column
-    if "mlforkids_outcome_label" not in df.columns:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid CSV file"
-        )
+        # the rest of the request is handled after any earlier
+        #  request for the same project has been queued, and
+        #  files for the request are recorded before any newer
+        #  request for the project, so that they can't overlap
+        ml.confirm_latest_request(scratch_key, request)
+        await ml.wait_for_recording(scratch_key)
+        ml.confirm_latest_request(scratch_key, request)
 
-    # check that there are training examples for multiple classes
-    #  otherwise model training will fail
-    numclasses = len(unique(df["mlforkids_outcome_label"]))
-    if numclasses < 2:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Examples needed for at least two classes to train a model"
-        )
+        # if a model has already been trained using identical
+        #  data, it can be reused without training it again
+        #  unless a worker is using the files for the project
+        #  or the stored files have been removed
+        if ml.is_stored(fingerprint) and not ml.is_training(scratch_key):
+            info("%s : Reusing previously trained model", scratch_key)
+            ml.cancel_queued(scratch_key)
+            savedmodel = create(scratch_key)
+            recording = ml.start_recording(scratch_key)
+            try:
+                reused = await run_in_threadpool(ml.reuse_model, fingerprint, savedmodel)
+            finally:
+                ml.finish_recording(scratch_key, recording)
+            if reused is not None:
+                increment("mlforkids_models_reused_total")
+                saved_models_cache[scratch_key] = reused
+                return reused
+            info("%s : Training stored model again", scratch_key)
+            ml.forget_model(fingerprint)
+
+        # check there is room in the queue, and enough memory
+        #  to train the model, before replacing any existing
+        #  model for this project
+        ml.confirm_memory(scratch_key, datasize)
+        ml.confirm_capacity(scratch_key)
+
+        # record placeholder status file to record training
+        info("%s : Creating model folder", scratch_key)
+        savedmodel = create(scratch_key)
+
+        recording = ml.start_recording(scratch_key)
+        try:
+            # keep a copy of the training data until the model
+            #  is trained, in case the server is restarted
+            job = await run_in_threadpool(record_job, savedmodel, csvfile.file)
+
+            # queue the model to be trained in a worker process,
+            #  replacing any model already training for the project
+            info("%s : Queuing model training", scratch_key)
+            ml.submit(savedmodel, df, fingerprint, datasize, job)
+        finally:
+            ml.finish_recording(scratch_key, recording)
+
+        # return the placeholder status to the client
+        info("%s : Returning status", scratch_key)
+        return savedmodel
+    finally:
+        ml.finish_request(scratch_key, request)
+
+
+# classify examples using a trained model
+#  accepts a CSV file or a JSON array of objects, and returns
+#  a list of labels sorted by confidence for each example
+@app.post("/models/{scratch_key}/predict")
+async def model_prediction_request(scratch_key: str, request: Request):
+    body = await request.body()
+    ml = await wait_for_warmup()
+    # the models cache isn't thread-safe, so the status of the
+    #  model is found before classifying in a thread
+    modelinfo = saved_models_cache.get(scratch_key)
+    if modelinfo is None:
+        modelinfo = await run_in_threadpool(read_status_file, scratch_key)
+    return await run_in_threadpool(ml.predict, modelinfo, body,
+                                   request.headers.get("content-type"))
 
-    # record placeholder status file to record training
-    info("%s : Creating model folder", scratch_key)
-    savedmodel = create(scratch_key)
 
-    # start training the model in a background thread
-    info("%s : Starting model thread", scratch_key)
-    background_tasks.add_task(train_model, savedmodel, df)
+# returns the status of a model from the models cache
+def get_cached_status(scratch_key: str):
+    modelinfo = saved_models_cache.get(scratch_key)
+    if modelinfo is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return modelinfo
 
-    # return the placeholder status to the client
-    info("%s : Returning status", scratch_key)
-    return savedmodel
+def etag_matches(etag: str, ifnonematch: str):
+    if ifnonematch is None:
+        return False
+    return etag in [ knownetag.strip().removeprefix("W/") for knownetag in ifnonematch.split(",") ]
+
+
+# get the status of a model without reading the status file
+#  clients that already have the latest status (identified by
+#   the If-None-Match header) get a 304 response
+#  clients can wait up to ?wait= seconds for the status to
+#   change, or, if they don't have a status yet, for training
+#   to finish
+@app.get("/models/{scratch_key}/status")
+async def model_status_request(scratch_key: str, request: Request, wait: float = 0):
+    ifnonematch = request.headers.get("if-none-match")
+    deadline = monotonic() + min(max(wait, 0), maxwait)
+
+    modelinfo = get_cached_status(scratch_key)
+    payload, etag = serialize_status(modelinfo)
+    while etag_matches(etag, ifnonematch) or (ifnonematch is None and modelinfo["status"] == "Training"):
+        remaining = deadline - monotonic()
+        if remaining <= 0 or not await wait_for_status_change(scratch_key, remaining):
+            break
+        modelinfo = get_cached_status(scratch_key)
+        payload, etag = serialize_status(modelinfo)
+
+    headers = { "ETag": etag, "Cache-Control": "no-cache" }
+    if etag_matches(etag, ifnonematch):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(payload, media_type="application/json", headers=headers)
+
+
+# sends server-sent events with the status of a model each
+#  time that it changes, until training has finished
+async def stream_status(scratch_key: str, lasteventid: str):
+    while True:
+        modelinfo = saved_models_cache.get_uncounted(scratch_key)
+        if modelinfo is None:
+            modelinfo = { "key": scratch_key, "status": "Unavailable" }
+        payload, etag = serialize_status(modelinfo)
+        if etag != lasteventid:
+            yield "id: " + etag + "\ndata: " + payload + "\n\n"
+            lasteventid = etag
+        if modelinfo["status"] != "Training":
+            return
+        if not await wait_for_status_change(scratch_key, keepalive):
+            yield ": keep-alive\n\n"
+
+@app.get("/models/{scratch_key}/status/stream")
+async def model_status_stream(scratch_key: str, request: Request):
+    get_cached_status(scratch_key)
+    return StreamingResponse(stream_status(scratch_key, request.headers.get("last-event-id")),
+                             media_type="text/event-stream",
+                             headers={ "Cache-Control": "no-cache" })
+
+
+# get the status of many models in a single request
+#  returns a status for every requested key, with models
+#   that aren't known reported as Unavailable
+@app.post("/model-statuses")
+async def model_statuses_request(statusrequest: StatusRequest,
+                                 credentials: HTTPBasicCredentials = Depends(security)):
+    check_credentials(credentials)
+    if len(statusrequest.keys) > maxkeys:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                            detail="Too many models requested")
+
+    statuses = {}
+    uncached = []
+    for scratch_key in statusrequest.keys:
+        modelinfo = saved_models_cache.get_uncounted(scratch_key)
+        if modelinfo is None:
+            uncached.append(scratch_key)
+        else:
+            statuses[scratch_key] = modelinfo
+    if len(uncached) > 0:
+        statuses.update(await run_in_threadpool(read_status_files, uncached))
+    return statuses
+
+
+# get the profiles of the jobs for a model, if profiling was
+#  enabled when the jobs were run
+@app.get("/models/{scratch_key}/profiles")
+async def model_profiles_request(scratch_key: str,
+                                 credentials: HTTPBasicCredentials = Depends(security)):
+    check_credentials(credentials)
+    get_cached_status(scratch_key)
+    profiles = await run_in_threadpool(read_profiles, scratch_key)
+    if len(profiles) == 0:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return profiles
+
+# download the full profile of a job, in the pstats format
+@app.get("/models/{scratch_key}/profiles/{name}.prof")
+async def model_profile_download(scratch_key: str, name: str,
+                                 credentials: HTTPBasicCredentials = Depends(security)):
+    check_credentials(credentials)
+    get_cached_status(scratch_key)
+    location = get_profile_location(scratch_key, name, ".prof")
+    if name not in profile_names or not exists(location):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return FileResponse(location,
+                        media_type="application/octet-stream",
+                        filename=scratch_key + "-" + name + ".prof")
@@ -0,0 +1,96 @@
+# core dependencies
+from logging import info
+from os import getenv
+from collections import deque
+# external dependencies
+from numpy import array, polyfit
+from pandas import DataFrame
+
+
+megabytes = 1024 * 1024
+
+# memory (bytes) that can be used by training jobs at once
+#  in addition to the memory used by idle worker processes
+budget = int(float(getenv("TRAINING_MEMORY_BUDGET_MB", "600")) * megabytes)
+# estimates are increased by this proportion to allow for
+#  differences between the estimate and the actual memory used
+margin = float(getenv("TRAINING_MEMORY_MARGIN", "1.2"))
+
+# memory used by a training job is estimated as
+#  base + (factor x size of the training data)
+#  starting from these values until they can be calibrated
+#  from the memory used by previous jobs
+estimator = {
+    "base": float(getenv("TRAINING_MEMORY_BASE_MB", "20")) * megabytes,
+    "factor": float(getenv("TRAINING_MEMORY_FACTOR", "2"))
+}
+# (size of training data, peak memory) for recent jobs
+observations = deque(maxlen=int(getenv("TRAINING_MEMORY_OBSERVATIONS", "50")))
+info("Training memory budget %d bytes", budget)
+
+
+# returns the memory (bytes) used by a training dataset
+def get_data_size(dataframe: DataFrame) -> int:
+    return int(dataframe.memory_usage(index=False, deep=True).sum())
+
+
+# returns the estimated memory (bytes) needed by a training job
+def estimate_memory(datasize: int) -> int:
+    return int((estimator["base"] + estimator["factor"] * datasize) * margin)
+
+
+# updates the estimator with the memory used by a training job
+#  the factor is fitted to the recent jobs if they have a wide
+#   enough range of sizes, and the base is chosen so that
+#   none of the recent jobs would have been underestimated
+def calibrate(scratchkey: str, datasize: int, used: int):
+    info("%s : Training used %d bytes for %d bytes of data (estimated %d)",
+         scratchkey, used, datasize, estimate_memory(datasize))
+    observations.append((datasize, used))
+    sizes = array([ observation[0] for observation in observations ], dtype=float)
+    useds = array([ observation[1] for observation in observations ], dtype=float)
+    if sizes.max() >= 2 * sizes.min() and sizes.max() - sizes.min() >= megabytes:
+        estimator["factor"] = max(float(polyfit(sizes, useds, 1)[0]), 1.0)
+    estimator["base"] = max(float((useds - estimator["factor"] * sizes).max()), 0.0)
+
+
+# resets the peak memory recorded for the current process
+#  returns the memory (bytes) currently used by the process
+#   or None if the peak can't be reset
+def reset_peak_memory():
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return None
+    return get_memory_field("VmRSS:")
+
+
+# returns the peak memory (bytes) used by the current process
+#  since reset_peak_memory was called
+def get_peak_memory():
+    return get_memory_field("VmHWM:")
+
+
+def get_memory_field(field: str):
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# calls a function, measuring how much more memory (bytes) the
+#  process needed while it was running
+#  returns the result of the function, and the memory used
+#   or None if it couldn't be measured
+def track_memory(function, *args):
+    start = reset_peak_memory()
+    result = function(*args)
+    peak = get_peak_memory()
+    if start is None or peak is None:
+        return result, None
+    return result, max(peak - start, 0)
@@ -0,0 +1,102 @@
+# core dependencies
+from math import inf
+
+
+# upper bounds (seconds) of the buckets used for timings
+duration_buckets = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, inf )
+
+# metrics reported by the server, in the order they are reported
+descriptions = {
+    "mlforkids_http_request_duration_seconds": ("histogram", "Time taken to respond to API requests"),
+    "mlforkids_csv_parse_seconds": ("histogram", "Time taken to read the training data from a CSV file"),
+    "mlforkids_training_stage_seconds": ("histogram", "Time taken by each stage of a training job"),
+    "mlforkids_training_seconds": ("histogram", "Time taken by training jobs, from start to finish"),
+    "mlforkids_training_jobs_total": ("counter", "Training jobs that have completed"),
+    "mlforkids_models_reused_total": ("counter", "Requests that reused a previously trained model"),
+    "mlforkids_visualisation_seconds": ("histogram", "Time taken to create visualisations of models"),
+    "mlforkids_visualisations_total": ("counter", "Visualisations that have been created"),
+    "mlforkids_models_cache_lookups_total": ("counter", "Lookups of models in the models cache"),
+    "mlforkids_models_cache_evictions_total": ("counter", "Models removed from the models cache"),
+    "mlforkids_startup_seconds": ("gauge", "Time taken for the server to be ready after it started"),
+    "mlforkids_training_jobs_inflight": ("gauge", "Training jobs submitted to the training pool"),
+    "mlforkids_training_jobs_running": ("gauge", "Training jobs being run by a worker"),
+    "mlforkids_training_jobs_waiting": ("gauge", "Training jobs waiting for memory or for a worker"),
+    "mlforkids_training_memory_reserved_bytes": ("gauge", "Estimated memory needed by submitted training jobs"),
+    "mlforkids_models_cached": ("gauge", "Models in the models cache"),
+    "mlforkids_models_stored": ("gauge", "Models in the model store"),
+    "mlforkids_disk_bytes": ("gauge", "Size of the files in each of the folders used by the server"),
+    "mlforkids_trash_pending_items": ("gauge", "Files and folders waiting to be deleted"),
+    "mlforkids_trash_pending_bytes": ("gauge", "Size of the files waiting to be deleted"),
+    "mlforkids_trash_collected_bytes_total": ("counter", "Bytes deleted from the trash"),
+}
+
+# current values of the metrics
+#  keyed by metric name, then by a tuple of label pairs
+samples = { name: {} for name in descriptions }
+
+
+def get_labels(labels: dict):
+    return tuple(sorted((labels or {}).items()))
+
+
+def increment(name: str, labels: dict = None, amount: float = 1):
+    values = samples[name]
+    key = get_labels(labels)
+    values[key] = values.get(key, 0) + amount
+
+
+def set_value(name: str, value: float, labels: dict = None):
+    samples[name][get_labels(labels)] = value
+
+
+def observe(name: str, value: float, labels: dict = None):
+    values = samples[name]
+    key = get_labels(labels)
+    if key not in values:
+        values[key] = { "buckets": [ 0 ] * len(duration_buckets), "sum": 0.0, "count": 0 }
+    histogram = values[key]
+    for index, bound in enumerate(duration_buckets):
+        if value <= bound:
+            histogram["buckets"][index] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+
+def format_value(value: float) -> str:
+    if value == inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                                                      .replace('"', '\\"')
+                                                      .replace("\n", "\\n"))
+                          for name, value in labels) + "}"
+
+
+# returns the current values of the metrics in the Prometheus
+#  text exposition format
+def render_metrics() -> str:
+    lines = []
+    for name, (type, help) in descriptions.items():
+        values = samples[name]
+        if len(values) == 0:
+            continue
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, type))
+        for labels, value in sorted(values.items()):
+            if type == "histogram":
+                for bound, count in zip(duration_buckets, value["buckets"]):
+                    lines.append("%s_bucket%s %s" % (name,
+                                                     format_labels(labels + (("le", format_value(bound)),)),
+                                                     count))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(value["sum"])))
+                lines.append("%s_count%s %s" % (name, format_labels(labels), value["count"]))
+            else:
+                lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,16 @@
+# functions used by the API server that need the ML libraries
+#  (pandas, ydf, sklearn), which are slow to import
+#  this module is imported in the background after the server
+#  starts, so that it can respond to healthchecks straight away
+
+# local dependencies
+from app.ingest import read_training_data
+from app.models import get_learner_options
+from app.modelstore import get_fingerprint, is_stored, forget_model, reuse_model, stored_models
+from app.memory import get_data_size
+from app.predict import predict
+from app.training import start_pool, start_visualisation_pool, stop_pool, warm_up_workers, read_recovered_jobs, resume_jobs
+from app.training import confirm_capacity, confirm_memory, submit, submit_visualisation
+from app.training import start_request, confirm_latest_request, finish_request, is_training, cancel_queued
+from app.training import start_recording, finish_recording, wait_for_recording
+from app.training import get_memory_stats, get_queue_stats, visualisationwait
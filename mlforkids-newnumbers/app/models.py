@@ -1,19 +1,118 @@
 # core dependencies
 from logging import info, exception
+from os import getenv
 from os.path import join
-from pathlib import Path
 from unicodedata import normalize, combining
 from traceback import format_exc
+from time import perf_counter
 # external dependencies
+from numpy import flatnonzero, argsort
 from pandas import DataFrame
-from ydf import GradientBoostedTreesLearner
+from ydf import GradientBoostedTreesLearner, GenericModel
 # local dependencies
-from app.savedmodels import get_location, update_status_file, cleanup
+from app.savedmodels import get_location, update_status_file, cleanup, start_job, is_job_cancelled
+from app.savedmodels import create_staging_folder, publish
+from app.warmstart import describe_dataset, hash_rows, find_warmstart, clear_warmstart, save_warmstart
+from app.warmstart import get_warmstart_location, warmstart_iterations
 from app.payloads import ModelInfo
-from app.viz import create_visualisation
-from app.utils import create_zip_flat, recursive_delete
+from app.viz import save_visualisation_data
+from app.packaging import package_model
+from app.profiling import record_stage
+from app.preprocessing import factorize_labels, reorder_labels, find_sample, find_constant_columns, compact_features
 
 
+outcome_label = "mlforkids_outcome_label"
+
+# number of threads used to train each model
+trainingthreads = int(getenv("TRAINING_THREADS", "1"))
+# seconds that can be spent adding trees to a model, after
+#  which the model is kept with the trees added so far
+timebudget = float(getenv("TRAINING_TIME_BUDGET", "60"))
+# seconds that a training job can take before it is failed
+maxseconds = float(getenv("TRAINING_MAX_SECONDS", "300"))
+# the number of trees in a model is reduced for larger
+#  datasets, to limit the number of (examples x columns x
+#  trees) to the tree budget
+mintrees = int(getenv("TRAINING_MIN_TREES", "20"))
+maxtrees = int(getenv("TRAINING_MAX_TREES", "300"))
+treebudget = int(getenv("TRAINING_TREE_BUDGET", "100000000"))
+# models are trained from a sample of datasets with more
+#  examples than this, as the models for kids' projects don't
+#  need more
+samplerows = int(getenv("TRAINING_SAMPLE_ROWS", "20000"))
+# maximum number of examples left out of a sample that are used
+#  to estimate the accuracy of the model
+heldoutrows = int(getenv("TRAINING_HELDOUT_ROWS", "5000"))
+info("Training models with %d threads, for up to %d seconds", trainingthreads, maxseconds)
+
+
+# options for the learner used to train a model
+def get_learner_options(dataframe: DataFrame) -> dict:
+    num_trees = max(mintrees, min(maxtrees, treebudget // max(dataframe.size, 1)))
+    return {
+        "label": outcome_label,
+        "num_trees": num_trees,
+        "early_stopping_num_trees_look_ahead": max(5, min(30, num_trees // 10))
+    }
+
+
+# trains a tiny model, so that YDF is loaded and ready before
+#  the first training job
+def prime_learner():
+    dataframe = DataFrame({ "feature": [ 0, 1 ] * 10, outcome_label: [ 0, 1 ] * 10 })
+    GradientBoostedTreesLearner(label=outcome_label, num_trees=1,
+                                num_threads=trainingthreads).train(dataframe)
+
+
+# raised by a training job that has been replaced by a newer
+#  request for the same project
+class TrainingCancelled(Exception):
+    pass
+
+
+# stops a training job that has been replaced by a newer
+#  request, so that the worker is free to train the newer model
+#  called between the stages of training, where the job can
+#  be stopped without leaving partial files in use
+def check_cancelled(key: str, job: str, stage: str):
+    if is_job_cancelled(key, job):
+        info("%s : Training cancelled while %s", key, stage)
+        raise TrainingCancelled("Training was replaced by a newer request (while %s)" % stage)
+
+
+# returns the accuracy of a model for examples that weren't
+#  used to train it
+#  models trained from a sample are evaluated using examples
+#   left out of the sample, otherwise the evaluation that YDF
+#   makes while training (using a validation set) is used
+#  returns None if the accuracy isn't available
+def estimate_accuracy(key: str, model: GenericModel, heldout: DataFrame):
+    try:
+        if heldout is not None:
+            return model.evaluate(heldout).accuracy
+        evaluation = model.self_evaluation()
+        if evaluation is not None:
+            return evaluation.accuracy
+    except:
+        exception("%s : Failed to evaluate model", key)
+    return None
+
+
+# returns the number of boosting iterations used to train a
+#  model, as models for more than two labels add a tree for
+#  each label in every iteration
+def count_iterations(model: GenericModel) -> int:
+    return model.num_trees() // model.num_trees_per_iteration()
+
+
+# fails a training job that has taken too long
+def check_deadline(key: str, job_start: float, stage: str):
+    elapsed = perf_counter() - job_start
+    if elapsed > maxseconds:
+        info("%s : Training exceeded time limit while %s", key, stage)
+        raise TimeoutError("Training took longer than the maximum of %g seconds (%d seconds, while %s)"
+                           % (maxseconds, elapsed, stage))
+
 
 def sanitize_feature_names(key: str, dataframe: DataFrame):
     info("%s : Renaming features for use with saved models", key)
@@ -53,22 +152,42 @@ def sanitize_feature_names(key: str, dataframe: DataFrame):
     return rename_mapping
 
 
-def train_model(modelinfo: ModelInfo, dataframe: DataFrame):
+# trains a model and publishes it for the project
+#  the time taken by each stage is added to stages
+#  raises TrainingCancelled if the job is replaced by a newer
+#   request before the model is published
+def train_model(modelinfo: ModelInfo, dataframe: DataFrame, stages: dict, job: str) -> ModelInfo:
     key = modelinfo["key"]
     info("%s : Training model", key)
+    job_start = perf_counter()
+    stage_start = job_start
+    check_cancelled(key, job, "waiting for a worker")
+    start_job(key, job)
     model_folder = get_location(key)
-    download_folder = join(model_folder, "download")
-    outcome_label = "mlforkids_outcome_label"
 
     try:
+        # the model is created in a staging folder, so that
+        #  the previous model is available until it is replaced
+        staging_folder = create_staging_folder(key)
+        download_folder = join(staging_folder, "download")
+
         # Identify classification target label and convert to strings first
         info("%s : Identifying target label", key)
         # Convert outcome labels to strings to ensure consistency
         dataframe[outcome_label] = dataframe[outcome_label].astype(str)
 
-        # Attempt to create a visualisation of the data
-        #  using string versions of original feature names
-        create_visualisation(key, dataframe, outcome_label, download_folder)
+        # Extract (unique) classes 
+        info("%s : Extracting unique classes", key)
+        labelcodes, classes = factorize_labels(dataframe[outcome_label])
+        info("%s : classes in target label : %s", key, classes)
+        rowhashes = hash_rows(dataframe)
+        stage_start = record_stage(stages, "setup", stage_start)
+
+        # Keep the data needed to create a visualisation if one
+        #  is requested, using string versions of original
+        #  feature names
+        save_visualisation_data(key, dataframe, staging_folder, labelcodes, rowhashes)
+        stage_start = record_stage(stages, "visualisation_data", stage_start)
 
         # Identify feature types for preparing test data
         modelinfo["features"] = {}
@@ -80,39 +199,136 @@ def train_model(modelinfo: ModelInfo, dataframe: DataFrame):
         for name in feature_names:
             modelinfo["features"][name]["name"] = feature_names[name]
 
-        # Extract (unique) classes 
-        info("%s : Extracting unique classes", key)
-        classes = list(dataframe[outcome_label].unique())
+        # Train from a sample of large datasets, keeping some of
+        #  the examples left out to estimate the accuracy of the
+        #  model
+        numrows = len(dataframe)
+        heldout = None
+        sample = find_sample(labelcodes, rowhashes, samplerows)
+        if sample is not None:
+            info("%s : Training with a sample of %d of %d examples", key, sample.sum(), numrows)
+            unused = flatnonzero(~sample)
+            unused = unused[argsort(rowhashes[unused], kind="stable")[:heldoutrows]]
+            heldout = dataframe.iloc[unused]
+            heldoutcodes = labelcodes[unused]
+            dataframe.drop(index=dataframe.index[~sample], inplace=True)
+            labelcodes = labelcodes[sample]
+            rowhashes = rowhashes[sample]
+
+        # Check if the previous model can be updated rather than
+        #  training a new model from scratch
+        #  the dataset is described before the training data is
+        #   compacted, as the types used for compact data depend
+        #   on the values in each column
+        constant = find_constant_columns(dataframe, outcome_label)
+        dataset = describe_dataset(dataframe, outcome_label, classes)
+        dataset["constant"] = constant
+        warmstart = find_warmstart(key, dataset, rowhashes)
+        if warmstart is not None:
+            # keep the order of the labels the previous model used
+            previous, iterations = warmstart
+            labelcodes = reorder_labels(labelcodes, classes, previous["labels"])
+            if heldout is not None:
+                heldoutcodes = reorder_labels(heldoutcodes, classes, previous["labels"])
+            classes = previous["labels"]
+            dataset["labels"] = classes
         modelinfo["labels"] = classes
-        info("%s : classes in target label : %s", key, classes)
-        dataframe[outcome_label] = dataframe[outcome_label].map(classes.index)
+        dataframe[outcome_label] = labelcodes
+        if heldout is not None:
+            heldout[outcome_label] = heldoutcodes
+
+        # reduce the memory used by the training data
+        #  the features metadata still describes the data as
+        #  it was provided, which is what is used to classify
+        compact_features(key, dataframe, outcome_label, constant)
+        stage_start = record_stage(stages, "prepare", stage_start)
 
         # Train a model
-        info("%s : Training a model", key)
-        model = GradientBoostedTreesLearner(label=outcome_label).train(dataframe)
+        check_deadline(key, job_start, "preparing the training data")
+        check_cancelled(key, job, "preparing the training data")
+        learner_options = get_learner_options(dataframe)
+        training_start = perf_counter()
+        resources = {
+            "num_threads": trainingthreads,
+            "maximum_training_duration_seconds": max(min(timebudget, maxseconds - (training_start - job_start)), 1.0)
+        }
+        model = None
+        if warmstart is not None:
+            info("%s : Updating the previous model", key)
+            try:
+                model = GradientBoostedTreesLearner(**{ **learner_options,
+                                                        "early_stopping": "NONE",
+                                                        "num_trees": iterations + warmstart_iterations },
+                                                    **resources,
+                                                    working_dir=get_warmstart_location(key),
+                                                    resume_training=True).train(dataframe)
+                training_mode = "Incremental"
+            except:
+                exception("%s : Failed to update the previous model", key)
+        if model is None:
+            info("%s : Training a model", key)
+            model = GradientBoostedTreesLearner(**learner_options,
+                                                **resources,
+                                                working_dir=clear_warmstart(key),
+                                                resume_training=True).train(dataframe)
+            training_mode = "Full"
+        modelinfo["training"] = {
+            "mode": training_mode,
+            "seconds": perf_counter() - training_start,
+            "trees": model.num_trees()
+        }
+        if modelinfo["training"]["seconds"] >= resources["maximum_training_duration_seconds"]:
+            info("%s : Training stopped by the time budget with %d trees", key, model.num_trees())
+        check_deadline(key, job_start, "training the model")
+        dataset["iterations"] = count_iterations(model)
+        save_warmstart(key, dataset, rowhashes, model)
+        stage_start = record_stage(stages, "fit", stage_start)
 
-        # save model
+        # Estimate the accuracy of the model, so users can see
+        #  if training with a sample affected it
+        modelinfo["sampling"] = {
+            "rows": numrows,
+            "sampled": len(dataframe),
+            "accuracy": estimate_accuracy(key, model, heldout)
+        }
+        del heldout
+        stage_start = record_stage(stages, "evaluate", stage_start)
+        check_cancelled(key, job, "training the model")
+
+        # save model as a zip for browser use
         info("%s : Saving the model", key)
-        model_location = join(model_folder, "model")
-        # reset in case this model has been trained before
-        recursive_delete(Path(model_location))
-        model.save(model_location)
-        info("%s : Zipping model for browser use", key)
-        create_zip_flat(model_location, join(download_folder, "model.zip"))
+        modelinfo["packaging"] = package_model(key, model, staging_folder,
+                                               join(download_folder, "model.zip"))
+        stage_start = record_stage(stages, "package", stage_start)
+
+        # replace the previous model
+        check_deadline(key, job_start, "saving the model")
+        check_cancelled(key, job, "saving the model")
+        modelinfo["version"] = publish(key)
 
         # update status
         info("%s : Updating the status", key)
         modelinfo["status"] = "Available"
         update_status_file(model_folder, modelinfo)
+        stage_start = record_stage(stages, "publish", stage_start)
 
         # delete the working files to save space
-        cleanup(model_folder)
+        cleanup(key)
+        record_stage(stages, "cleanup", stage_start)
 
         # training complete
         info("%s : Training complete", key)
+        return modelinfo
+
+    except TrainingCancelled:
+        # the status belongs to the newer request, so is left
+        #  for that job to update
+        cleanup(key)
+        raise
 
     except Exception as trainerr:
         exception("%s : Failed to train model", key)
+        record_stage(stages, "failed", stage_start)
 
         # update status
         modelinfo["status"] = "Failed"
@@ -121,3 +337,4 @@ def train_model(modelinfo: ModelInfo, dataframe: DataFrame):
             "stack": format_exc()
         }
         update_status_file(model_folder, modelinfo)
+        return modelinfo
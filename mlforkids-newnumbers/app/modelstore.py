@@ -0,0 +1,170 @@
+# core dependencies
+from logging import info, warning
+from os import getenv, mkdir, link
+from os.path import join, exists
+from pathlib import Path
+from shutil import copy2
+from hashlib import sha256
+from json import dump, dumps, load
+from datetime import datetime
+from typing import Optional
+# external dependencies
+from cachetools import LRUCache
+from pandas import DataFrame
+from pandas.util import hash_pandas_object
+from ydf import __version__ as ydf_version
+# local dependencies
+from app.payloads import ModelInfo
+from app.models import outcome_label
+from app.savedmodels import get_location, update_status_file
+from app.savedmodels import get_visualisation_data_location, create_staging_folder, publish, cleanup
+from app.utils import compressed_copies
+from app.trash import move_to_trash
+
+
+# initialising folder for models that can be reused for
+#  projects that are trained with identical data
+if not exists("model-store"):
+    info("Creating model store folder")
+    mkdir("model-store")
+
+# files that are copied from a trained model into the store
+stored_files = [ "model.zip" ] + [ filename + extension
+                                   for filename in [ "tree.svg", "tree.dot", "vocab.json" ]
+                                   for extension in [ "" ] + [ copy[0] for copy in compressed_copies ] ]
+# project-independent fields from the model status
+stored_fields = [ "features", "labels", "training", "packaging", "sampling" ]
+
+
+# returns relative location of the stored files for a dataset
+def get_store_location(fingerprint: str):
+    return join("model-store", fingerprint)
+
+
+# preparing index of stored models
+storesize = int(getenv("MODEL_STORE_SIZE", "50"))
+info("Preparing model store for %d models", storesize)
+class store_with_cleanup(LRUCache):
+    def popitem(self):
+        fingerprint, value = super().popitem()
+        info("Removing %s from model store", fingerprint)
+        move_to_trash(Path(get_store_location(fingerprint)))
+        return fingerprint, value
+stored_models = store_with_cleanup(maxsize=storesize)
+
+# models stored by a previous run are indexed in the order
+#  they were stored, so the oldest are evicted first
+for folder in sorted(Path("model-store").iterdir(), key=lambda path: path.stat().st_mtime):
+    if folder.is_dir():
+        stored_models[folder.name] = True
+
+
+# returns a hash that identifies the data and options used to
+#  train a model, so that identical requests can be recognised
+#  intended to be run in a thread, not on the event loop
+def get_fingerprint(dataframe: DataFrame, learner_options: dict) -> str:
+    # labels are hashed in the form that they're trained with
+    dataframe = dataframe.assign(**{ outcome_label: dataframe[outcome_label].astype(str) })
+
+    fingerprint = sha256()
+    fingerprint.update(dumps({
+        "ydf": ydf_version,
+        "learner": learner_options,
+        "columns": [ [ column, dtype.name ] for column, dtype in dataframe.dtypes.items() ]
+    }, sort_keys=True).encode())
+    fingerprint.update(hash_pandas_object(dataframe, index=False).values.tobytes())
+    return fingerprint.hexdigest()
+
+
+# copies a file without duplicating it on disk if possible
+def link_file(source: str, target: str):
+    try:
+        link(source, target)
+    except OSError:
+        copy2(source, target)
+
+
+# keeps the files for a newly trained model so that they can
+#  be reused by later requests to train with the same data
+def store_model(fingerprint: str, modelinfo: ModelInfo):
+    if fingerprint in stored_models:
+        return
+    download_folder = join(get_location(modelinfo["key"]), "download")
+    # the published model could have been replaced or removed
+    #  before training completed
+    if not exists(join(download_folder, "model.zip")):
+        warning("%s : Published model not found, so not adding to store", modelinfo["key"])
+        return
+    info("%s : Adding model to store as %s", modelinfo["key"], fingerprint)
+
+    store_folder = get_store_location(fingerprint)
+    move_to_trash(Path(store_folder))
+    mkdir(store_folder)
+    for filename in stored_files:
+        source = join(download_folder, filename)
+        if exists(source):
+            link_file(source, join(store_folder, filename))
+    # keep the data for creating a visualisation, if one
+    #  hasn't been requested yet
+    visualisation_data = get_visualisation_data_location(modelinfo["key"])
+    if exists(visualisation_data):
+        link_file(visualisation_data, join(store_folder, "visualisation.pkl"))
+    with open(join(store_folder, "modelinfo.json"), "w") as storedinfo:
+        dump({ field: modelinfo[field] for field in stored_fields if field in modelinfo }, storedinfo)
+
+    stored_models[fingerprint] = True
+
+
+# checks if a model has been trained with the same data,
+#  marking the stored model as recently used
+def is_stored(fingerprint: str) -> bool:
+    return stored_models.get(fingerprint, False)
+
+
+# removes a stored model that can't be reused
+def forget_model(fingerprint: str):
+    info("Removing %s from model store", fingerprint)
+    stored_models.pop(fingerprint, None)
+    move_to_trash(Path(get_store_location(fingerprint)))
+
+
+# makes a previously trained model available for a project
+#  instead of training it again
+#  returns None if the stored model files are missing, so
+#  the model needs to be trained
+#  intended to be run in a thread, not on the event loop, so
+#  the caller updates the models cache with the result
+def reuse_model(fingerprint: str, modelinfo: ModelInfo) -> Optional[ModelInfo]:
+    key = modelinfo["key"]
+    store_folder = get_store_location(fingerprint)
+    if not exists(join(store_folder, "model.zip")):
+        warning("%s : Stored model %s not found", key, fingerprint)
+        return None
+    info("%s : Reusing stored model %s", key, fingerprint)
+    modelinfo = dict(modelinfo)
+
+    model_folder = get_location(key)
+    staging_folder = create_staging_folder(key)
+    download_folder = join(staging_folder, "download")
+    for filename in stored_files:
+        source = join(store_folder, filename)
+        if exists(source):
+            link_file(source, join(download_folder, filename))
+    stored_visualisation_data = join(store_folder, "visualisation.pkl")
+    if exists(stored_visualisation_data):
+        link_file(stored_visualisation_data, join(staging_folder, "visualisation.pkl"))
+    version = publish(key)
+    cleanup(key)
+    with open(join(store_folder, "modelinfo.json")) as storedinfo:
+        modelinfo.update(load(storedinfo))
+
+    modelinfo["training"] = { **modelinfo.get("training", { "trees": 0 }),
+                              "mode": "Reused",
+                              "seconds": 0 }
+    if "packaging" in modelinfo:
+        modelinfo["packaging"] = { **modelinfo["packaging"], "seconds": 0 }
+    modelinfo["status"] = "Available"
+    modelinfo["version"] = version
+    modelinfo["lastupdate"] = datetime.now()
+    update_status_file(model_folder, modelinfo)
+    return modelinfo
@@ -0,0 +1,61 @@
+# core dependencies
+from logging import info
+from os import getenv, walk, access, W_OK
+from os.path import join, getsize, isdir
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+
+# folder where models are saved before they are zipped
+#  such as a tmpfs folder like /dev/shm, so that the model
+#  files are only written to disk once, as the zip file
+#  /dev/shm is used by default if it is available, and
+#  models are saved in the staging folder if this is empty
+sharedmemory = "/dev/shm"
+default_packaging_folder = sharedmemory if isdir(sharedmemory) and access(sharedmemory, W_OK) else ""
+packaging_folder = getenv("MODEL_PACKAGING_FOLDER", default_packaging_folder) or None
+info("Saving models for packaging in %s", packaging_folder or "staging folders")
+# deflate level used for model files in the zip
+compresslevel = int(getenv("MODEL_ZIP_LEVEL", "6"))
+# files smaller than this (bytes) are stored without compression
+#  as there is very little to be saved by compressing them
+storebelow = int(getenv("MODEL_ZIP_STORE_BELOW", "1024"))
+# files that are already compressed
+compressed_extensions = ( ".zip", ".gz", ".br" )
+
+
+# chooses how a file should be added to the model zip
+def get_compression(filename: str, size: int):
+    if size < storebelow or filename.endswith(compressed_extensions):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+# creates a zip with all of the files for a saved model, in
+#  a single folder, as expected by ydf-inference in browsers
+def zip_model_files(source_folder: str, zip_location: str):
+    with ZipFile(zip_location, "w") as zipf:
+        for root, _, files in walk(source_folder):
+            for file in sorted(files):
+                file_path = join(root, file)
+                compression = get_compression(file, getsize(file_path))
+                zipf.write(file_path, file,
+                           compress_type=compression,
+                           compresslevel=compresslevel if compression == ZIP_DEFLATED else None)
+
+
+# saves a trained model as a zip file that can be downloaded
+#  returns the time taken and the size of the zip
+def package_model(key: str, model, staging_folder: str, zip_location: str) -> dict:
+    packaging_start = perf_counter()
+    with TemporaryDirectory(dir=packaging_folder or staging_folder) as save_folder:
+        model_location = join(save_folder, "model")
+        model.save(model_location)
+        zip_model_files(model_location, zip_location)
+    packaging = {
+        "seconds": perf_counter() - packaging_start,
+        "bytes": getsize(zip_location)
+    }
+    info("%s : Packaged model in %d bytes", key, packaging["bytes"])
+    return packaging
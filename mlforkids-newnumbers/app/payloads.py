@@ -17,6 +17,28 @@ class ModelLocations(BaseModel):
     dot: str
     vocab: str
 
+class TrainingMode(str, Enum):
+    Full = "Full"
+    Incremental = "Incremental"
+    Reused = "Reused"
+
+class TrainingInfo(BaseModel):
+    mode: TrainingMode
+    seconds: float
+    trees: int
+
+class PackagingInfo(BaseModel):
+    seconds: float
+    bytes: int
+
+# training sets with more examples than the limit are sampled
+#  accuracy is measured using examples that weren't used to
+#  train the model
+class SamplingInfo(BaseModel):
+    rows: int
+    sampled: int
+    accuracy: Optional[float]
+
 class ErrorInfo(BaseModel):
     message: str
     stack: str
@@ -29,4 +51,12 @@ class ModelInfo(BaseModel):
     features: dict
     labels: List[str]
     error: Optional[ErrorInfo]
-    lastupdate: datetime
\ No newline at end of file
+    training: Optional[TrainingInfo]
+    packaging: Optional[PackagingInfo]
+    sampling: Optional[SamplingInfo]
+    version: Optional[str]
+    lastupdate: datetime
+
+# request payload for looking up the status of many models
+class StatusRequest(BaseModel):
+    keys: List[str]
@@ -0,0 +1,141 @@
+# core dependencies
+from logging import info, exception
+from os import getenv
+from os.path import join, exists
+from io import BytesIO
+from json import loads
+from zipfile import ZipFile
+from tempfile import TemporaryDirectory
+from threading import Lock
+# external dependencies
+from cachetools import LRUCache
+from fastapi import HTTPException, status
+from numpy import ndarray, column_stack, argsort, take_along_axis
+from pandas import DataFrame, read_csv, to_numeric
+from ydf import load_model
+# local dependencies
+from app.payloads import ModelInfo
+from app.savedmodels import get_location
+
+
+# number of trained models kept in memory for predictions
+poolsize = int(getenv("PREDICT_MODELS_CACHE_SIZE", "10"))
+# maximum number of examples in a single prediction request
+maxrows = int(getenv("PREDICT_MAX_ROWS", "10000"))
+info("Preparing prediction pool for %d models", poolsize)
+loaded_models = LRUCache(maxsize=poolsize)
+loaded_models_lock = Lock()
+
+outcome_label = "mlforkids_outcome_label"
+numeric_types = [ "int64", "float64", "int32", "float32", "bool" ]
+
+
+def invalid_request(detail: str, status_code=status.HTTP_400_BAD_REQUEST):
+    return HTTPException(status_code=status_code, detail=detail)
+
+
+# rejects requests for models that aren't ready to be used
+def confirm_available(modelinfo: ModelInfo):
+    if modelinfo is None or modelinfo["status"] != "Available":
+        raise invalid_request("Model not available", status.HTTP_404_NOT_FOUND)
+
+
+# returns a trained model, loading it from the zip file
+#  that was created for browsers if it isn't in memory
+def get_loaded_model(modelinfo: ModelInfo):
+    scratchkey = modelinfo["key"]
+    with loaded_models_lock:
+        loaded = loaded_models.get(scratchkey)
+    if loaded is not None and loaded[0] == modelinfo["lastupdate"]:
+        return loaded[1]
+
+    info("%s : Loading model for predictions", scratchkey)
+    model_zip = join(get_location(scratchkey), "download", "model.zip")
+    if not exists(model_zip):
+        raise invalid_request("Model not available", status.HTTP_404_NOT_FOUND)
+    with TemporaryDirectory() as model_folder:
+        with ZipFile(model_zip) as zipf:
+            zipf.extractall(model_folder)
+        model = load_model(model_folder)
+
+    with loaded_models_lock:
+        loaded_models[scratchkey] = (modelinfo["lastupdate"], model)
+    return model
+
+
+# parses the examples to classify from a request body
+#  containing either a CSV file or a JSON array of objects
+def parse_examples(body: bytes, contenttype: str) -> DataFrame:
+    try:
+        if contenttype is not None and contenttype.startswith("text/csv"):
+            examples = read_csv(BytesIO(body), nrows=maxrows + 1)
+        else:
+            rows = loads(body)
+            if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+                raise invalid_request("Examples should be a list of objects")
+            examples = DataFrame(rows[:maxrows + 1])
+    except HTTPException:
+        raise
+    except:
+        exception("Failed to parse examples")
+        raise invalid_request("Unable to process examples")
+
+    if len(examples) == 0:
+        raise invalid_request("No examples provided")
+    if len(examples) > maxrows:
+        raise invalid_request("Too many examples", status.HTTP_413_CONTENT_TOO_LARGE)
+    return examples
+
+
+# prepares the examples using the same feature names and
+#  types as were used to train the model
+def prepare_examples(modelinfo: ModelInfo, examples: DataFrame) -> DataFrame:
+    prepared = {}
+    for feature, details in modelinfo["features"].items():
+        if details["name"] == outcome_label:
+            continue
+        if feature not in examples.columns:
+            raise invalid_request("Missing required value " + feature)
+        if details["type"] in numeric_types:
+            prepared[details["name"]] = to_numeric(examples[feature], errors="coerce")
+        else:
+            # YDF can't classify missing text values, so they are
+            #  treated as a value that wasn't in the training data
+            prepared[details["name"]] = examples[feature].astype(str).fillna("")
+    return DataFrame(prepared)
+
+
+# returns the confidence of each label for every example
+#  as a matrix with a row per example and a column per label
+def get_confidences(modelinfo: ModelInfo, predictions: ndarray) -> ndarray:
+    if len(modelinfo["labels"]) == 2:
+        # binary classifiers only return the confidence
+        #  for the second label
+        return column_stack([ 1 - predictions, predictions ])
+    return predictions
+
+
+# returns a list of labels, sorted by confidence, for every example
+def rank_labels(modelinfo: ModelInfo, confidences: ndarray):
+    labels = modelinfo["labels"]
+    percentages = (confidences * 100).astype(int)
+    order = argsort(-percentages, axis=1, kind="stable")
+    ranked = take_along_axis(percentages, order, axis=1).tolist()
+    return [
+        [ { "class_name": labels[label], "confidence": confidence }
+            for label, confidence in zip(row_order, row_confidences) ]
+        for row_order, row_confidences in zip(order.tolist(), ranked)
+    ]
+
+
+# classifies a batch of examples using a trained model
+#  intended to be run in a thread, not on the event loop, with
+#  the status of the model found by the event loop
+def predict(modelinfo: ModelInfo, body: bytes, contenttype: str):
+    confirm_available(modelinfo)
+    scratchkey = modelinfo["key"]
+    examples = prepare_examples(modelinfo, parse_examples(body, contenttype))
+    model = get_loaded_model(modelinfo)
+    info("%s : Classifying %d examples", scratchkey, len(examples))
+    confidences = get_confidences(modelinfo, model.predict(examples))
+    return rank_labels(modelinfo, confidences)
@@ -0,0 +1,93 @@
+# core dependencies
+from logging import info
+from os import getenv
+# external dependencies
+from numpy import ndarray, bincount, maximum, lexsort, cumsum, concatenate, arange, zeros
+from pandas import DataFrame, Series, Index, Categorical, factorize, to_numeric
+from pandas.api.types import is_bool_dtype, is_integer_dtype, is_float_dtype, is_numeric_dtype
+
+
+# text columns are stored as categories when the number of
+#  unique values is at most this proportion of the number of
+#  training examples, as each value is then only stored once
+maxcategoryratio = float(getenv("TRAINING_CATEGORY_MAX_RATIO", "0.5"))
+
+
+# returns the index of the label for each training example,
+#  and the labels in the order that they first appear
+def factorize_labels(labels: Series):
+    codes, uniques = factorize(labels)
+    return codes, list(uniques)
+
+
+# returns the index of the label for each training example
+#  using a different order for the labels
+def reorder_labels(codes: ndarray, classes: list, order: list) -> ndarray:
+    return Index(order).get_indexer(classes)[codes]
+
+
+# chooses a sample of the training examples, with examples of
+#  every label in the same proportions as the full dataset
+#  examples are chosen by their hashes, so that the same
+#   examples are chosen each time a project is trained, and
+#   adding a few examples only changes a few of those chosen
+#  returns a mask of the examples in the sample, or None if
+#   there are no more than maxrows examples
+def find_sample(labelcodes: ndarray, rowhashes: ndarray, maxrows: int):
+    numrows = len(labelcodes)
+    if numrows <= maxrows:
+        return None
+    counts = bincount(labelcodes)
+    quotas = maximum(1, counts * maxrows // numrows)
+    # position of each example among the examples with the
+    #  same label, in the order of their hashes
+    order = lexsort((rowhashes, labelcodes))
+    sortedcodes = labelcodes[order]
+    starts = concatenate(([ 0 ], cumsum(counts)[:-1]))
+    ranks = arange(numrows) - starts[sortedcodes]
+    sample = zeros(numrows, dtype=bool)
+    sample[order[ranks < quotas[sortedcodes]]] = True
+    return sample
+
+
+# returns the feature columns that have the same value for
+#  every training example, as they can't be used to train
+#  a model
+#  if every feature is constant, they are all kept so that
+#   there is something to train with
+def find_constant_columns(dataframe: DataFrame, outcome_label: str) -> list:
+    constant = [ column for column in dataframe.columns
+                 if column != outcome_label and dataframe[column].nunique(dropna=False) <= 1 ]
+    if len(constant) == len(dataframe.columns) - 1:
+        return []
+    return constant
+
+
+# reduces the memory used by the training data before it is
+#  given to YDF
+#  numbers are stored using the smallest type that holds them
+#   (YDF uses 32-bit floats for all numbers, so the model
+#   isn't changed)
+#  text columns with few unique values are stored as
+#   categories
+#  constant columns are removed
+#  the dataframe is updated in place, so that the memory used
+#   by the original columns can be freed
+def compact_features(key: str, dataframe: DataFrame, outcome_label: str, constant: list):
+    dataframe.drop(columns=constant, inplace=True)
+    categorical = 0
+    for column in dataframe.columns:
+        values = dataframe[column]
+        if column == outcome_label or is_bool_dtype(values):
+            continue
+        if is_integer_dtype(values):
+            dataframe[column] = to_numeric(values, downcast="integer")
+        elif is_float_dtype(values):
+            dataframe[column] = to_numeric(values, downcast="float")
+        elif not is_numeric_dtype(values):
+            codes, uniques = factorize(values)
+            if len(uniques) <= maxcategoryratio * len(values):
+                dataframe[column] = Categorical.from_codes(codes, uniques)
+                categorical += 1
+    info("%s : Compacted training data (%d constant columns removed, %d categorical columns)",
+         key, len(constant), categorical)
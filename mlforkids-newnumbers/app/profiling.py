@@ -0,0 +1,160 @@
+# core dependencies
+from logging import info, exception
+from os import getenv, makedirs
+from os.path import join, exists
+from cProfile import Profile
+from pstats import Stats
+from random import random
+from json import dumps, load
+from marshal import dump as marshal_dump
+from time import perf_counter
+from datetime import datetime
+import tracemalloc
+# local dependencies
+from app.savedmodels import get_working_location
+from app.utils import replace_on_close
+
+
+# proportion of jobs that are profiled, from 0 (none) to 1 (all)
+#  profiling makes jobs slower, so this is intended to be
+#  enabled while investigating a problem
+samplerate = float(getenv("PROFILE_SAMPLE_RATE", "0"))
+# number of functions and allocations included in a profile
+topstats = int(getenv("PROFILE_TOP_STATS", "25"))
+
+# jobs that can be profiled
+profile_names = ( "training", "visualisation" )
+
+# largest snapshot of allocated memory taken during the
+#  current job, as (bytes allocated, snapshot)
+checkpoint = None
+
+
+# returns relative location of the profiles for a project
+def get_profiles_location(scratchkey: str):
+    return join(get_working_location(scratchkey), "profiles")
+
+def get_profile_location(scratchkey: str, name: str, extension: str):
+    return join(get_profiles_location(scratchkey), name + extension)
+
+
+def should_profile() -> bool:
+    return samplerate > 0 and random() < samplerate
+
+
+# takes a snapshot of allocated memory if more memory is
+#  allocated than at the last checkpoint, so that profiles
+#  show what was using memory when the most was needed
+#  does nothing unless the current job is being profiled
+def take_memory_checkpoint():
+    global checkpoint
+    if not tracemalloc.is_tracing():
+        return
+    current, _ = tracemalloc.get_traced_memory()
+    if checkpoint is None or current > checkpoint[0]:
+        checkpoint = (current, tracemalloc.take_snapshot())
+
+
+# records the time taken by a stage of a job, to be reported
+#  when the job is complete
+#  returns the time that the next stage started
+def record_stage(stages: dict, stage: str, stage_start: float) -> float:
+    take_memory_checkpoint()
+    now = perf_counter()
+    stages[stage] = now - stage_start
+    return now
+
+
+# calls a function, profiling it if the job has been sampled
+#  the profile is saved with the working files for the
+#  project, whether the function succeeds or fails
+def run_with_profiling(scratchkey: str, name: str, function, *args):
+    global checkpoint
+    if not should_profile():
+        return function(*args)
+
+    info("%s : Profiling %s job", scratchkey, name)
+    checkpoint = None
+    tracemalloc.start()
+    profiler = Profile()
+    job_start = perf_counter()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        seconds = perf_counter() - job_start
+        take_memory_checkpoint()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        try:
+            save_profile(scratchkey, name, profiler, checkpoint, seconds, peak)
+        except:
+            exception("%s : Failed to save profile", scratchkey)
+        checkpoint = None
+
+
+def get_function_stats(profiler: Profile):
+    stats = Stats(profiler)
+    functions = []
+    for (filename, line, function), (_, calls, totaltime, cumulativetime, _) in stats.stats.items():
+        functions.append({
+            "function": function,
+            "file": filename,
+            "line": line,
+            "calls": calls,
+            "totaltime": totaltime,
+            "cumulativetime": cumulativetime
+        })
+    functions.sort(key=lambda function: function["cumulativetime"], reverse=True)
+    return functions[:topstats]
+
+
+def get_allocation_stats(snapshot):
+    allocations = []
+    for statistic in snapshot.statistics("lineno")[:topstats]:
+        frame = statistic.traceback[0]
+        allocations.append({
+            "file": frame.filename,
+            "line": frame.lineno,
+            "bytes": statistic.size,
+            "count": statistic.count
+        })
+    return allocations
+
+
+# saves a summary of a profile as JSON, and the full profile
+#  in the pstats format so that it can be explored with
+#  tools like snakeviz
+#  the allocations are from the snapshot taken when the most
+#  memory was allocated
+def save_profile(scratchkey: str, name: str, profiler: Profile, checkpoint: tuple, seconds: float, peak: int):
+    allocated, snapshot = checkpoint
+    makedirs(get_profiles_location(scratchkey), exist_ok=True)
+    summary = {
+        "job": name,
+        "created": datetime.now().isoformat(),
+        "seconds": seconds,
+        "memory": {
+            "peak": peak,
+            "snapshot": allocated
+        },
+        "functions": get_function_stats(profiler),
+        "allocations": get_allocation_stats(snapshot)
+    }
+    with replace_on_close(get_profile_location(scratchkey, name, ".json")) as summaryfile:
+        summaryfile.write(dumps(summary))
+    profiler.create_stats()
+    with replace_on_close(get_profile_location(scratchkey, name, ".prof"), "wb") as statsfile:
+        marshal_dump(profiler.stats, statsfile)
+    info("%s : Saved profile of %s job", scratchkey, name)
+
+
+# returns the summaries of the profiles saved for a project
+#  intended to be run in a thread, not on the event loop
+def read_profiles(scratchkey: str) -> dict:
+    profiles = {}
+    for name in profile_names:
+        location = get_profile_location(scratchkey, name, ".json")
+        if exists(location):
+            with open(location) as summaryfile:
+                profiles[name] = load(summaryfile)
+    return profiles
@@ -1,16 +1,24 @@
 # core dependencies
-from logging import info
+from logging import info, warning, exception
 from os.path import isdir, join, exists
-from os import environ, mkdir
+from os import environ, getenv, mkdir, rename, replace, symlink
 from pathlib import Path
 from datetime import datetime
-from json import dump
+from time import time
+from json import dumps, load, loads
+from shutil import copyfileobj
+from sqlite3 import connect
+from contextlib import closing
+from typing import BinaryIO
+from uuid import uuid4
 # external dependencies
-from cachetools import LRUCache
-from fastapi import HTTPException, status
+from cachetools import TLRUCache
 # local dependencies
 from app.payloads import ModelInfo
-from app.utils import recursive_delete, json_serializer
+from app.utils import json_serializer, folder_size, write_with_compressed_copies
+from app.trash import move_to_trash
+from app.statusupdates import status_changed
+from app.metrics import increment
 
 
 # initialising saved models folder
@@ -18,19 +26,87 @@ if not exists("saved-models"):
     info("Creating models folder")
     mkdir("saved-models")
 
+# initialising folder for files that are needed to train
+#  models, but which shouldn't be served to clients
+if not exists("working-files"):
+    info("Creating working files folder")
+    mkdir("working-files")
+
+# initialising persistent queue of training jobs, so that
+#  jobs can be recovered after the server is restarted
+jobs_location = join("working-files", "jobs.sqlite")
+def jobs_database():
+    return closing(connect(jobs_location, timeout=30))
+with jobs_database() as db, db:
+    db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                   "scratchkey TEXT PRIMARY KEY, "
+                   "state TEXT NOT NULL, "
+                   "modelinfo TEXT NOT NULL)")
+    # each job is identified, so that a job can tell if it has
+    #  been replaced by a newer request for the same project
+    #  jobs recorded before this have an empty identifier
+    columns = [ column[1] for column in db.execute("PRAGMA table_info(jobs)") ]
+    if "job" not in columns:
+        db.execute("ALTER TABLE jobs ADD COLUMN job TEXT NOT NULL DEFAULT ''")
+
 # identifying direct URL for saved models
 hostname = environ["PUBLIC_API_URL"]
 info("Using root API %s", hostname)
 
 # preparing models cache
+#  models are evicted when there are too many of them, when
+#  they use too much disk space, or when they are too old
 cachesize = int(environ["MODELS_CACHE_SIZE"])
-info("Preparing models cache for %d models", cachesize)
-class cache_with_cleanup(LRUCache):
+diskbudget = int(float(getenv("MODELS_DISK_BUDGET_MB", "500")) * 1024 * 1024)
+ttl = float(getenv("MODELS_TTL_HOURS", "24")) * 60 * 60
+info("Preparing models cache for %d models, %d bytes, %d seconds", cachesize, diskbudget, ttl)
+class cache_with_cleanup(TLRUCache):
+    def get(self, key, default=None):
+        found = key in self
+        increment("mlforkids_models_cache_lookups_total", { "result": "hit" if found else "miss" })
+        return super().get(key, default)
+    # lookups made by the service itself, rather than for a
+    #  request for a model, aren't counted in the metrics
+    def get_uncounted(self, key, default=None):
+        return super().get(key, default)
+    def __setitem__(self, key, value):
+        # remove the previous size of the model before
+        #  working out if there is room for the new size
+        if key in self:
+            super().__delitem__(key)
+        super().__setitem__(key, value)
+        if key not in self:
+            info("%s : Model has expired", key)
+            increment("mlforkids_models_cache_evictions_total", { "reason": "expired" })
+            delete(key)
+        while len(self) > cachesize:
+            self.popitem()
+        status_changed(key)
     def popitem(self):
         key, value = super().popitem()
+        info("%s : Evicting model from cache", key)
+        increment("mlforkids_models_cache_evictions_total", { "reason": "capacity" })
         delete(key)
+        status_changed(key)
         return key, value
-saved_models_cache = cache_with_cleanup(maxsize=cachesize)
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for key, value in expired:
+            info("%s : Model has expired", key)
+            increment("mlforkids_models_cache_evictions_total", { "reason": "expired" })
+            delete(key)
+            status_changed(key)
+        return expired
+def get_model_size(modelinfo: ModelInfo):
+    scratchkey = modelinfo["key"]
+    size = folder_size(get_location(scratchkey)) + folder_size(get_working_location(scratchkey))
+    return min(size, diskbudget)
+def get_model_expiry(scratchkey: str, modelinfo: ModelInfo, now: float):
+    return modelinfo["lastupdate"].timestamp() + ttl
+saved_models_cache = cache_with_cleanup(maxsize=diskbudget,
+                                        ttu=get_model_expiry,
+                                        timer=time,
+                                        getsizeof=get_model_size)
 
 
 # returns relative location of the model folder for a project
@@ -38,51 +114,93 @@ def get_location(scratchkey: str):
     return join("saved-models", scratchkey)
 
 
+# returns relative location of the working files for a project
+def get_working_location(scratchkey: str):
+    return join("working-files", scratchkey)
+
+
+# returns relative location of the data used to create a
+#  visualisation of a model when it is first requested
+def get_visualisation_data_location(scratchkey: str):
+    return join(get_working_location(scratchkey), "visualisation.pkl")
+
+
+# returns relative location of the files for a model that
+#  is being trained, before they are made available to clients
+def get_staging_location(scratchkey: str):
+    return join(get_working_location(scratchkey), "staging")
+
+
 # Deletes files for a previous saved model
 def delete(scratchkey: str):
     folder_location = get_location(scratchkey)
     folder = Path(folder_location)
-    recursive_delete(folder)
-
-
-# used when handling a request to train a new model
-#  checks if there is already a model in-flight and throws
-#   an exception if there is
-def confirm_model_isnt_training(scratchkey: str):
-    info("%s : Checking for existing model", scratchkey)
-
-    if saved_models_cache.__contains__(scratchkey):
-        info("%s : Model already known", scratchkey)
-        saved_model = saved_models_cache[scratchkey]
-        if saved_model["status"] == "Training":
-            info("%s : Model training in progress. Rejecting request")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Model training in progress"
-            )
-        # otherwise, model is in a "ready" state, and we will
-        #  replace it with a new model
-        # or a previous attempt failed and is in an "error" state
-    else:
-        info("%s : Model not known", scratchkey)
+    move_to_trash(folder)
+    move_to_trash(Path(get_working_location(scratchkey)))
 
 
 # creates a folder where models can be saved
-#  deletes any existing files/folders that are already there
-def create_clean_folder(scratchkey: str):
-    # identify folder where model will be saved
-    models_folder_location = get_location(scratchkey)
-    models_folder = Path(models_folder_location)
-
-    # check if there is already a saved model for this project
-    if isdir(models_folder):
-        recursive_delete(models_folder)
-
-    # create new folder and return
-    mkdir(models_folder)
+#  any existing model for the project is left in place, so
+#  that it can still be downloaded until it is replaced
+def create_model_folder(scratchkey: str):
+    models_folder = Path(get_location(scratchkey))
+    if not isdir(models_folder):
+        mkdir(models_folder)
     return models_folder
 
 
+# creates an empty folder for the files of a new model
+#  deletes anything left behind by a previous attempt
+def create_staging_folder(scratchkey: str):
+    working_folder = get_working_location(scratchkey)
+    if not isdir(working_folder):
+        mkdir(working_folder)
+    staging_folder = get_staging_location(scratchkey)
+    move_to_trash(Path(staging_folder))
+    mkdir(staging_folder)
+    mkdir(join(staging_folder, "download"))
+    return staging_folder
+
+
+# makes the files for a new model available to clients
+#  returns the version of the model that was published
+#  the download folder is a link to a folder for each version
+#   of the model, so that the previous version can be replaced
+#   in a single step without clients seeing a partial model
+def publish(scratchkey: str):
+    info("%s : Publishing model files", scratchkey)
+    model_folder = get_location(scratchkey)
+    staging_folder = get_staging_location(scratchkey)
+
+    version = "v" + uuid4().hex
+    rename(join(staging_folder, "download"), join(model_folder, version))
+
+    # replace the data for visualising the previous model
+    visualisation_data = Path(get_visualisation_data_location(scratchkey))
+    staged_visualisation_data = Path(staging_folder, visualisation_data.name)
+    if staged_visualisation_data.exists():
+        replace(staged_visualisation_data, visualisation_data)
+    elif visualisation_data.exists():
+        visualisation_data.unlink()
+
+    download_link = join(model_folder, "download")
+    staged_link = join(model_folder, "download.tmp")
+    if Path(staged_link).is_symlink():
+        Path(staged_link).unlink()
+    symlink(version, staged_link)
+    if isdir(download_link) and not Path(download_link).is_symlink():
+        # download folder created before models were versioned
+        rename(download_link, join(model_folder, "v" + uuid4().hex))
+    replace(staged_link, download_link)
+
+    # remove previous versions of the model
+    for path in Path(model_folder).iterdir():
+        if path.is_dir() and not path.is_symlink() and path.name != version:
+            move_to_trash(path)
+
+    return version
+
+
 # creates a new model record, and writes it to a file
 #  returns the same info as a dict for returning to clients
 def create_status_file(location: Path, scratchkey: str) -> ModelInfo:
@@ -120,31 +238,198 @@ def update_status_file(model_folder: Path, info: ModelInfo):
     # if the model has been cleaned out, ignore
     if Path(model_folder).exists():
         # create status file
-        with open(join(model_folder, "status"), "w") as statusfile:
-            # write JSON payload to file
-            dump(info, statusfile, default=json_serializer)
+        write_with_compressed_copies(join(model_folder, "status"),
+                                     dumps(info, default=json_serializer).encode())
 
 
 # Create a new saved model for the specified project
+#  any model that is already training for the project is
+#  replaced (see app.training)
 def create(scratchkey: str):
-    # raise an exception if there is already a model training
-    #  for this project
-    confirm_model_isnt_training(scratchkey)
     # create a folder to store this model
-    folder = create_clean_folder(scratchkey)
+    folder = create_model_folder(scratchkey)
     # create a new status object to represent a new model
     return create_status_file(folder, scratchkey)
 
 
-# delete working files from the model folder, leaving
-#  only the tfjs model and the visualisation ready for
-#  download
-def cleanup(model_folder: str):
-    model_folder_path = Path(model_folder)
-    for path in model_folder_path.iterdir():
-        if path.is_dir():
-            if path.name != "download":
-                recursive_delete(path)
-        elif path.is_file() and path.name != "status":
-            path.unlink()
+# delete working files used to create a model, leaving
+#  only the published model and the visualisation ready
+#  for download
+def cleanup(scratchkey: str):
+    move_to_trash(Path(get_staging_location(scratchkey)))
+
+
+# returns the location of the training data for a queued job
+def get_job_csv_location(scratchkey: str):
+    return join(get_working_location(scratchkey), "training.csv")
+
+
+# records a copy of the training data for a new training job
+#  so that it can be replayed if the server is restarted
+#  before the model has been trained
+#  any previous job for the project is replaced
+#  returns the identifier for the job
+def record_job(modelinfo: ModelInfo, csvfile: BinaryIO) -> str:
+    scratchkey = modelinfo["key"]
+    info("%s : Recording training job", scratchkey)
+
+    working_folder = get_working_location(scratchkey)
+    if not isdir(working_folder):
+        mkdir(working_folder)
+    csvfile.seek(0)
+    with open(get_job_csv_location(scratchkey), "wb") as jobfile:
+        copyfileobj(csvfile, jobfile)
+
+    job = uuid4().hex
+    with jobs_database() as db, db:
+        db.execute("INSERT OR REPLACE INTO jobs (scratchkey, state, modelinfo, job) VALUES (?, ?, ?, ?)",
+                   (scratchkey, "Queued", dumps(modelinfo, default=json_serializer), job))
+    return job
+
+
+# records that a worker has started training a queued job
+def start_job(scratchkey: str, job: str):
+    with jobs_database() as db, db:
+        db.execute("UPDATE jobs SET state = ? WHERE scratchkey = ? AND job = ?",
+                   ("Training", scratchkey, job))
+
+
+# checks if a job has been replaced by a newer request for
+#  the same project, or cancelled
+#  used by workers to stop training jobs that are no longer
+#   needed, so intended to be cheap enough to call often
+def is_job_cancelled(scratchkey: str, job: str) -> bool:
+    with jobs_database() as db:
+        recorded = db.execute("SELECT job FROM jobs WHERE scratchkey = ?", (scratchkey,)).fetchone()
+    return recorded is None or recorded[0] != job
+
+
+# removes a completed training job from the queue
+#  does nothing if the job has already been replaced by a
+#   newer request, as the training data belongs to that job
+def complete_job(scratchkey: str, job: str):
+    with jobs_database() as db, db:
+        removed = db.execute("DELETE FROM jobs WHERE scratchkey = ? AND job = ?",
+                             (scratchkey, job)).rowcount
+    job_csv = Path(get_job_csv_location(scratchkey))
+    if removed > 0 and job_csv.exists():
+        job_csv.unlink()
+
+
+# removes a training job that hasn't been started from the
+#  queue, whichever request it was for
+def cancel_job(scratchkey: str):
+    with jobs_database() as db, db:
+        db.execute("DELETE FROM jobs WHERE scratchkey = ?", (scratchkey,))
+    job_csv = Path(get_job_csv_location(scratchkey))
+    if job_csv.exists():
+        job_csv.unlink()
+
+
+# marks a model that will never finish training as failed,
+#  and removes anything left behind by the interrupted job
+#  the models cache isn't updated, as this is called from the
+#  warm-up thread, so callers update it from the event loop
+def fail_interrupted_model(modelinfo: ModelInfo):
+    scratchkey = modelinfo["key"]
+    warning("%s : Training was interrupted", scratchkey)
+    cleanup(scratchkey)
+    modelinfo["status"] = "Failed"
+    modelinfo["error"] = {
+        "message": "Training was interrupted by a server restart",
+        "stack": ""
+    }
+    update_status_file(get_location(scratchkey), modelinfo)
+
+
+# reads the status file for a saved model, if there is one
+def read_status_file(scratchkey: str):
+    status_location = join(get_location(scratchkey), "status")
+    if not exists(status_location):
+        return None
+    with open(status_location) as statusfile:
+        modelinfo = load(statusfile)
+    modelinfo["lastupdate"] = datetime.fromisoformat(modelinfo["lastupdate"])
+    return modelinfo
+
+
+# reads the status files for models that aren't in the
+#  models cache, reporting models without a status file as
+#  unavailable
+def read_status_files(scratchkeys: list) -> dict:
+    statuses = {}
+    for scratchkey in scratchkeys:
+        modelinfo = None
+        # keys from request bodies aren't restricted to a single
+        #  path segment, unlike keys from request URLs
+        if scratchkey not in ("", ".", "..") and "/" not in scratchkey and "\\" not in scratchkey:
+            try:
+                modelinfo = read_status_file(scratchkey)
+            except:
+                exception("%s : Failed to read status", scratchkey)
+        if modelinfo is None:
+            modelinfo = { "key": scratchkey, "status": "Unavailable" }
+        statuses[scratchkey] = modelinfo
+    return statuses
+
+
+# called on startup to handle jobs from a previous run
+#  jobs that were waiting to be trained are returned, with
+#   their identifiers, so that they can be queued again
+#  models that were left in a Training state by any other job
+#   are marked as failed, as the job may have been what
+#   stopped the previous run, and are also returned
+#  doesn't update the models cache, so that it can be called
+#   from a thread
+def recover_jobs():
+    with jobs_database() as db:
+        jobs = db.execute("SELECT scratchkey, state, modelinfo, job FROM jobs").fetchall()
+
+    queued = []
+    for scratchkey, state, modelinfo, job in jobs:
+        modelinfo = loads(modelinfo)
+        modelinfo["lastupdate"] = datetime.fromisoformat(modelinfo["lastupdate"])
+        if state == "Queued" and exists(get_job_csv_location(scratchkey)):
+            info("%s : Recovering queued training job", scratchkey)
+            queued.append((modelinfo, job))
+        else:
+            complete_job(scratchkey, job)
+
+    interrupted = []
+    queued_keys = set(modelinfo["key"] for modelinfo, _ in queued)
+    for folder in Path("saved-models").iterdir():
+        if folder.is_dir() and folder.name not in queued_keys:
+            modelinfo = read_status_file(folder.name)
+            if modelinfo is not None and modelinfo["status"] == "Training":
+                fail_interrupted_model(modelinfo)
+                interrupted.append(modelinfo)
+
+    return queued, interrupted
+
+
+# called on startup to add models saved by a previous run to
+#  the cache, oldest first, so that they can be evicted
+def load_saved_models():
+    folders = []
+    for folder in Path("saved-models").iterdir():
+        status_location = Path(folder, "status")
+        if folder.is_dir() and status_location.exists():
+            folders.append((status_location.stat().st_mtime, folder.name))
+        else:
+            info("%s : Removing model without a status", folder.name)
+            delete(folder.name)
+
+    for _, scratchkey in sorted(folders):
+        try:
+            saved_models_cache[scratchkey] = read_status_file(scratchkey)
+        except:
+            exception("%s : Removing model with an unreadable status", scratchkey)
+            delete(scratchkey)
+    info("Loaded %d saved models using %d bytes", len(saved_models_cache), saved_models_cache.currsize)
 
+    # remove working files left behind for models that
+    #  have since been deleted
+    for folder in Path("working-files").iterdir():
+        if folder.is_dir() and folder.name not in saved_models_cache:
+            info("%s : Removing working files for unknown model", folder.name)
+            move_to_trash(folder)
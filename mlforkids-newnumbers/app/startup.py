@@ -0,0 +1,108 @@
+# core dependencies
+from logging import info, exception
+from os import getenv
+from time import monotonic
+from importlib import import_module
+from threading import Thread
+from asyncio import get_running_loop, shield, wait_for
+# external dependencies
+from fastapi import HTTPException, status
+
+
+# longest time (seconds) that a request will wait for the
+#  server to finish starting before it is rejected
+startupwait = float(getenv("STARTUP_WAIT", "30"))
+# seconds that clients are asked to wait before retrying
+#  requests that were rejected while the server was starting
+retryafter = getenv("STARTUP_RETRY_AFTER", "5")
+
+# progress of loading the ML libraries and warming up the
+#  training workers
+#  status is one of Starting, Warming, Ready, Failed
+#  seconds is the time it took for the server to be ready
+state = {
+    "status": "Starting",
+    "seconds": None
+}
+started = monotonic()
+
+# the app.mlstack module, once the training processes
+#  have been started
+started_mlstack = None
+# the app.mlstack module, once the server is ready
+mlstack = None
+# completes when the server is ready
+ready = None
+
+
+# loads the ML libraries in the background, so that the server
+#  can respond to requests that don't need them, such as
+#  healthchecks, while it is starting
+#  must be called from the event loop
+def start_warmup():
+    global ready
+    loop = get_running_loop()
+    ready = loop.create_future()
+    Thread(target=warm_up, args=(loop,), name="warmup", daemon=True).start()
+
+
+def warm_up(loop):
+    global started_mlstack
+    try:
+        info("Loading ML libraries")
+        module = import_module("app.mlstack")
+        state["status"] = "Warming"
+        module.start_pool()
+        module.start_visualisation_pool()
+        started_mlstack = module
+        module.warm_up_workers()
+        recovered = module.read_recovered_jobs()
+        loop.call_soon_threadsafe(finish_warmup, module, recovered)
+    except Exception as warmuperr:
+        exception("Failed to start server")
+        loop.call_soon_threadsafe(fail_warmup, warmuperr)
+
+
+def finish_warmup(module, recovered: tuple):
+    global mlstack
+    mlstack = module
+    mlstack.resume_jobs(recovered)
+    state["status"] = "Ready"
+    state["seconds"] = monotonic() - started
+    info("Server ready after %.1f seconds", state["seconds"])
+    ready.set_result(module)
+
+
+def fail_warmup(warmuperr: Exception):
+    state["status"] = "Failed"
+    ready.set_exception(warmuperr)
+
+
+def stop_warmup():
+    if started_mlstack is not None:
+        started_mlstack.stop_pool()
+
+
+# returns the app.mlstack module, or None if the server is
+#  still starting
+def get_mlstack():
+    return mlstack
+
+
+# returns the app.mlstack module, waiting for it to be loaded
+#  if the server is still starting
+#  rejects the request if the server doesn't start in time
+async def wait_for_warmup():
+    if mlstack is not None:
+        return mlstack
+    try:
+        return await wait_for(shield(ready), timeout=startupwait)
+    except TimeoutError:
+        info("Server is still starting. Rejecting request")
+    except Exception:
+        info("Server failed to start. Rejecting request")
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="The server is starting. Please try again later",
+        headers={"Retry-After": retryafter}
+    )
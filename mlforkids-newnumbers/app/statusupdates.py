@@ -0,0 +1,60 @@
+# core dependencies
+from logging import info
+from os import getenv
+from asyncio import Event, wait_for
+from hashlib import sha1
+from json import dumps
+# local dependencies
+from app.payloads import ModelInfo
+from app.utils import json_serializer
+
+
+# longest time (seconds) that a status request can wait for
+#  the status of a model to change
+maxwait = float(getenv("STATUS_MAX_WAIT", "30"))
+# seconds between keep-alive messages sent to clients
+#  streaming status updates
+keepalive = float(getenv("STATUS_KEEPALIVE", "15"))
+# maximum number of models in a single bulk status request
+maxkeys = int(getenv("STATUS_MAX_KEYS", "1000"))
+info("Status requests can wait for up to %d seconds", maxwait)
+
+
+# clients waiting for the status of a model to change
+#  keyed by scratch key
+waiting = {}
+
+
+# called whenever the status of a model is changed in the
+#  models cache, to wake up any clients waiting for it
+#  must be called from the event loop
+def status_changed(scratchkey: str):
+    for event in waiting.pop(scratchkey, []):
+        event.set()
+
+
+# waits until the status of a model changes, or until the
+#  timeout (in seconds) expires
+#  returns True if the status changed
+async def wait_for_status_change(scratchkey: str, timeout: float) -> bool:
+    event = Event()
+    waiting.setdefault(scratchkey, set()).add(event)
+    try:
+        await wait_for(event.wait(), timeout)
+        return True
+    except TimeoutError:
+        return False
+    finally:
+        events = waiting.get(scratchkey)
+        if events is not None:
+            events.discard(event)
+            if len(events) == 0:
+                del waiting[scratchkey]
+
+
+# returns the status of a model as it would be written to
+#  the status file, with an ETag that identifies the version
+def serialize_status(modelinfo: ModelInfo):
+    payload = dumps(modelinfo, default=json_serializer)
+    etag = '"' + sha1(payload.encode()).hexdigest() + '"'
+    return payload, etag
@@ -0,0 +1,521 @@
+# core dependencies
+from logging import info, exception, basicConfig
+from os import getenv
+from time import perf_counter
+from asyncio import wrap_future, get_running_loop, shield
+from collections import deque
+from itertools import count
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from traceback import format_exception
+# external dependencies
+from fastapi import HTTPException, status
+from pandas import DataFrame
+# local dependencies
+from app.models import train_model, get_learner_options, outcome_label, prime_learner, TrainingCancelled
+from app.viz import create_deferred_visualisation
+from app.modelstore import get_fingerprint, store_model
+from app.ingest import read_training_data
+from app.memory import budget, estimator, observations, get_data_size, estimate_memory, calibrate
+from app.memory import track_memory
+from app.metrics import observe, increment
+from app.profiling import run_with_profiling
+from app.payloads import ModelInfo
+from app.savedmodels import saved_models_cache, get_location, update_status_file
+from app.savedmodels import recover_jobs, complete_job, cancel_job, get_job_csv_location, fail_interrupted_model
+
+
+# number of worker processes used to train models
+workers = int(getenv("TRAINING_WORKERS", "1"))
+# number of training requests that can be waiting for a worker
+queuedepth = int(getenv("TRAINING_QUEUE_DEPTH", "10"))
+# seconds that clients are asked to wait when the queue is full
+retryafter = getenv("TRAINING_RETRY_AFTER", "30")
+# number of worker processes used to create visualisations
+visualisationworkers = int(getenv("VISUALISATION_WORKERS", "1"))
+# longest time (seconds) that a request will wait for a
+#  visualisation to be created before it is rejected
+visualisationwait = float(getenv("VISUALISATION_WAIT", "30"))
+info("Preparing training pool with %d workers and queue depth %d", workers, queuedepth)
+
+
+# pool of processes used to run training jobs, so that
+#  training doesn't compete with the API server for the GIL
+executor = None
+# pool of processes used to create visualisations, so that
+#  requests for a visualisation don't wait behind training jobs
+visualisation_executor = None
+
+# training jobs that have been submitted to a worker but not
+#  completed, keyed by scratch key
+inflight = {}
+
+# estimated memory for each of the submitted training jobs
+#  keyed by scratch key
+reserved = {}
+# training jobs waiting for memory before they can be submitted
+queued = deque()
+
+# state of the training job for each project, keyed by scratch key
+#  Queued      waiting for memory before it can be submitted
+#  Training    submitted to a worker
+#  Cancelling  replaced by a newer request, and waiting for the
+#               worker to stop before the newer request is
+#               submitted, so that only one job at a time uses
+#               the files for a project
+#  projects without a training job are not included
+job_states = {}
+# changes of state allowed for the training job for a project
+#  with None for projects without a training job
+job_transitions = {
+    None: ( "Queued", "Training" ),
+    "Queued": ( "Training", None ),
+    "Training": ( "Cancelling", None ),
+    "Cancelling": ( "Queued", "Training", None )
+}
+# newest requests for projects with jobs that are Cancelling
+#  keyed by scratch key
+replacements = {}
+
+# newest training request for each project that is still
+#  being read, keyed by scratch key
+requests = {}
+request_ids = count()
+
+# training requests that are being recorded, keyed by scratch
+#  key, so that requests for the same project are recorded and
+#  queued in the order that they were received
+recordings = {}
+
+# visualisations that are being created, keyed by scratch key
+visualisations = {}
+
+
+# debug logging for the worker processes
+#  the app modules are imported before this is run, and their
+#  module-level logging has already configured the root logger,
+#  so it is replaced
+def prepare_worker():
+    if getenv("MODE") == "development":
+        basicConfig(filename="mlforkids.log", encoding="utf-8", level="INFO", force=True)
+
+
+def start_pool():
+    global executor
+    info("Starting training pool")
+    executor = ProcessPoolExecutor(max_workers=workers,
+                                   mp_context=get_context("spawn"),
+                                   initializer=prepare_worker)
+
+
+def start_visualisation_pool():
+    global visualisation_executor
+    info("Starting visualisation pool")
+    visualisation_executor = ProcessPoolExecutor(max_workers=visualisationworkers,
+                                                 mp_context=get_context("spawn"),
+                                                 initializer=prepare_worker)
+
+
+# starts the worker processes, and trains a tiny model in
+#  each of them, so that the first training jobs don't have
+#  to wait for the ML libraries to be loaded
+#  blocks until the workers are ready, so intended to be run
+#   in a thread, not on the event loop
+def warm_up_workers():
+    info("Warming up training workers")
+    for job in [ executor.submit(prime_learner) for _ in range(workers) ]:
+        try:
+            job.result()
+        except:
+            exception("Failed to warm up training worker")
+
+
+def stop_pool():
+    info("Stopping training pool")
+    executor.shutdown(wait=False, cancel_futures=True)
+    visualisation_executor.shutdown(wait=False, cancel_futures=True)
+
+
+# used when handling a request to train a new model
+#  rejects the request if there are already too many
+#  models waiting to be trained
+#  requests that replace a job for the same project are
+#   always accepted, as they take the place of that job
+def confirm_capacity(scratchkey: str):
+    if scratchkey not in job_states and len(inflight) + len(queued) >= workers + queuedepth:
+        info("%s : Training queue is full. Rejecting request", scratchkey)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many models are being trained. Please try again later",
+            headers={"Retry-After": retryafter}
+        )
+
+
+# used when handling a request to train a new model
+#  rejects the request if training would need more memory
+#  than is available, even without any other jobs
+def confirm_memory(scratchkey: str, datasize: int):
+    estimate = estimate_memory(datasize)
+    if estimate > budget:
+        info("%s : Training needs %d bytes. Rejecting request", scratchkey, estimate)
+        raise HTTPException(
+            status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+            detail="Training data is too large to train a model"
+        )
+
+
+# used when handling a request to train a new model, before
+#  the training data is read
+#  returns an identifier for the request
+def start_request(scratchkey: str) -> int:
+    request = next(request_ids)
+    requests[scratchkey] = request
+    return request
+
+# used when handling a request to train a new model, after
+#  the training data has been read
+#  rejects the request if a newer request for the same
+#  project was received while the data was being read
+def confirm_latest_request(scratchkey: str, request: int):
+    if requests.get(scratchkey) != request:
+        info("%s : Replaced by a newer training request. Rejecting request", scratchkey)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Replaced by a newer request to train a model"
+        )
+
+def finish_request(scratchkey: str, request: int):
+    if requests.get(scratchkey) == request:
+        del requests[scratchkey]
+
+
+# used when handling a request to train a new model, before
+#  files for the request are written outside of the event loop
+#  returns an identifier for the recording
+def start_recording(scratchkey: str):
+    recording = get_running_loop().create_future()
+    recordings[scratchkey] = recording
+    return recording
+
+def finish_recording(scratchkey: str, recording):
+    recording.set_result(None)
+    if recordings.get(scratchkey) is recording:
+        del recordings[scratchkey]
+
+# waits until an earlier request for the same project has
+#  finished being recorded
+async def wait_for_recording(scratchkey: str):
+    while scratchkey in recordings:
+        await shield(recordings[scratchkey])
+
+
+def set_job_state(scratchkey: str, state: str):
+    previous = job_states.get(scratchkey)
+    if state not in job_transitions[previous]:
+        raise RuntimeError("Training job for %s cannot change from %s to %s" % (scratchkey, previous, state))
+    info("%s : Training job %s -> %s", scratchkey, previous, state)
+    if state is None:
+        del job_states[scratchkey]
+    else:
+        job_states[scratchkey] = state
+
+
+# returns true if a worker is using the files for a project
+def is_training(scratchkey: str) -> bool:
+    return job_states.get(scratchkey) in ( "Training", "Cancelling" )
+
+
+# trains a model in a worker process, recording the memory
+#  used so that memory estimates can be calibrated, and the
+#  time taken by each stage of training
+def run_training_job(modelinfo: ModelInfo, dataframe: DataFrame, job: str):
+    stages = {}
+    result, used = track_memory(run_with_profiling, modelinfo["key"], "training",
+                                train_model, modelinfo, dataframe, stages, job)
+    return result, used, stages
+
+
+# creates a visualisation in a worker process
+#  returns the time taken
+def run_visualisation_job(scratchkey: str):
+    visualisation_start = perf_counter()
+    run_with_profiling(scratchkey, "visualisation",
+                       create_deferred_visualisation, scratchkey, outcome_label)
+    return perf_counter() - visualisation_start
+
+
+# queue a model to be trained by the next available worker
+#  jobs wait until there is enough memory for them, unless
+#   there are no other jobs
+#  any job for the same project is replaced
+#   jobs that are waiting for memory are replaced in the queue
+#   jobs that have been submitted to a worker are cancelled,
+#    and the new job is submitted when the worker has stopped
+#  must be called from the event loop, so that the status
+#  updates are made on the same thread as API requests
+def submit(modelinfo: ModelInfo, dataframe: DataFrame, fingerprint: str, datasize: int, job: str):
+    key = modelinfo["key"]
+    trainingjob = (modelinfo, dataframe, fingerprint, datasize, job)
+    state = job_states.get(key)
+    if state == "Queued":
+        info("%s : Replacing queued training job", key)
+        queued[find_queued(key)] = trainingjob
+    elif state == "Training":
+        info("%s : Cancelling training job to replace it", key)
+        set_job_state(key, "Cancelling")
+        replacements[key] = trainingjob
+        # jobs that a worker hasn't started can be cancelled
+        #  straight away, otherwise the worker stops at the
+        #  next point where it checks for cancellation
+        inflight[key].cancel()
+    elif state == "Cancelling":
+        info("%s : Replacing training job waiting for cancellation", key)
+        replacements[key] = trainingjob
+    else:
+        enqueue(trainingjob)
+
+
+def enqueue(trainingjob: tuple, first: bool = False):
+    modelinfo, dataframe, fingerprint, datasize, job = trainingjob
+    estimate = estimate_memory(datasize)
+    if (first or len(queued) == 0) and (len(inflight) == 0 or sum(reserved.values()) + estimate <= budget):
+        admit(trainingjob, estimate)
+    else:
+        info("%s : Waiting for %d bytes of memory to train model", modelinfo["key"], estimate)
+        set_job_state(modelinfo["key"], "Queued")
+        if first:
+            queued.appendleft(trainingjob)
+        else:
+            queued.append(trainingjob)
+
+
+def admit(trainingjob: tuple, estimate: int):
+    modelinfo, dataframe, fingerprint, datasize, job = trainingjob
+    key = modelinfo["key"]
+    set_job_state(key, "Training")
+    pool = executor
+    future = pool.submit(run_training_job, modelinfo, dataframe, job)
+    inflight[key] = future
+    reserved[key] = estimate
+    wrap_future(future).add_done_callback(
+        lambda completed: training_complete(modelinfo, fingerprint, datasize, job, pool, future, completed))
+
+
+# submits jobs that were waiting for memory, in the order
+#  that they were requested
+def admit_queued():
+    while len(queued) > 0:
+        trainingjob = queued[0]
+        estimate = estimate_memory(trainingjob[3])
+        if len(inflight) > 0 and sum(reserved.values()) + estimate > budget:
+            return
+        queued.popleft()
+        admit(trainingjob, estimate)
+
+
+def find_queued(scratchkey: str) -> int:
+    for index, (modelinfo, _, _, _, _) in enumerate(queued):
+        if modelinfo["key"] == scratchkey:
+            return index
+
+
+# cancels a training job that is waiting for memory, such as
+#  when a newer request for the project reuses a stored model
+#  jobs that have been submitted to a worker can't be
+#   cancelled this way, as the worker is using the files for
+#   the project
+def cancel_queued(scratchkey: str):
+    if job_states.get(scratchkey) == "Queued":
+        info("%s : Cancelling queued training job", scratchkey)
+        del queued[find_queued(scratchkey)]
+        set_job_state(scratchkey, None)
+        cancel_job(scratchkey)
+
+
+# returns the number of submitted training jobs that a worker
+#  has started
+#  jobs that fit in the memory budget are submitted to the pool
+#   straight away, so can be waiting in the pool for a worker
+#  the pool marks a job as running when it is passed to a worker
+#   process, which can happen to one more job than there are
+#   workers
+def count_running() -> int:
+    return min(workers, sum(1 for future in inflight.values() if future.running()))
+
+
+# returns the number of training jobs, for monitoring
+#  training is the number of jobs that a worker has started
+#  waiting includes jobs waiting for memory, and jobs that have
+#   been submitted to the pool but not started
+def get_queue_stats():
+    running = count_running()
+    return {
+        "training": running,
+        "submitted": len(inflight),
+        "waiting": len(queued) + len(inflight) - running,
+        "cancelling": len(replacements),
+        "capacity": workers + queuedepth
+    }
+
+
+# returns the memory used by training jobs, for monitoring
+def get_memory_stats():
+    return {
+        "budget": budget,
+        "reserved": sum(reserved.values()),
+        "training": len(inflight),
+        "waiting": len(queued),
+        "estimator": {
+            "base": int(estimator["base"]),
+            "factor": estimator["factor"],
+            "observations": len(observations)
+        }
+    }
+
+
+# records the outcome of a training job in the models cache
+#  and keeps successfully trained models for reuse
+def training_complete(modelinfo: ModelInfo, fingerprint: str, datasize: int, jobid: str,
+                      pool: ProcessPoolExecutor, future, job):
+    key = modelinfo["key"]
+    finished = inflight.get(key) is future
+    replaced = finished and job_states.get(key) == "Cancelling"
+    if finished:
+        del inflight[key]
+        del reserved[key]
+
+    if job.cancelled() and not replaced:
+        # job is left in the persistent queue so that it
+        #  can be resumed when the server is restarted
+        info("%s : Training job cancelled", key)
+        return
+    complete_job(key, jobid)
+
+    trainerr = None if job.cancelled() else job.exception()
+    if job.cancelled() or isinstance(trainerr, TrainingCancelled):
+        info("%s : Training job replaced by a newer request", key)
+        result = { "status": "Cancelled" }
+    elif trainerr is None:
+        result, used, stages = job.result()
+        if used is not None:
+            calibrate(key, datasize, used)
+        outcome = { "outcome": result["status"] }
+        for stage, seconds in stages.items():
+            observe("mlforkids_training_stage_seconds", seconds, { "stage": stage, **outcome })
+        observe("mlforkids_training_seconds", sum(stages.values()), outcome)
+        if result["status"] == "Available":
+            store_model(fingerprint, result)
+    else:
+        # the worker failed before it could record the outcome
+        #  of training, so update the status file on its behalf
+        exception("%s : Training job failed", key, exc_info=trainerr)
+        result = dict(modelinfo)
+        result["status"] = "Failed"
+        result["error"] = {
+            "message": str(trainerr) or "Training worker stopped unexpectedly",
+            "stack": "".join(format_exception(trainerr))
+        }
+        if not replaced:
+            update_status_file(get_location(key), result)
+
+        if isinstance(trainerr, BrokenProcessPool) and pool is executor:
+            info("Replacing broken training pool")
+            start_pool()
+    increment("mlforkids_training_jobs_total", { "outcome": result["status"] })
+
+    # only update the cache if the model is still known,
+    #  so that evicted models aren't reintroduced
+    if saved_models_cache.get_uncounted(key) is modelinfo:
+        saved_models_cache[key] = result
+
+    # the newest request for the project takes the place of
+    #  the replaced job, ahead of jobs that are waiting
+    #  the worker may have updated the status file before it
+    #   stopped, so it is restored for the newest request
+    if replaced:
+        trainingjob = replacements.pop(key, None)
+        if trainingjob is None:
+            set_job_state(key, None)
+        else:
+            update_status_file(get_location(key), trainingjob[0])
+            enqueue(trainingjob, first=True)
+    elif finished:
+        set_job_state(key, None)
+
+    # the memory reserved for this job can now be used by
+    #  any jobs that were waiting for it
+    if finished:
+        admit_queued()
+
+
+# creates the visualisation of a model in a visualisation
+#  worker process
+#  returns an awaitable that completes when the files are ready
+#  requests for a visualisation that is already being created
+#   share the same job
+def submit_visualisation(scratchkey: str):
+    if scratchkey not in visualisations:
+        pool = visualisation_executor
+        job = wrap_future(pool.submit(run_visualisation_job, scratchkey))
+        visualisations[scratchkey] = job
+        job.add_done_callback(lambda completed: visualisation_complete(scratchkey, pool, completed))
+    return visualisations[scratchkey]
+
+
+def visualisation_complete(scratchkey: str, pool: ProcessPoolExecutor, job):
+    visualisations.pop(scratchkey, None)
+    if job.cancelled():
+        return
+    if job.exception() is None:
+        observe("mlforkids_visualisation_seconds", job.result())
+        increment("mlforkids_visualisations_total", { "outcome": "Available" })
+    else:
+        increment("mlforkids_visualisations_total", { "outcome": "Failed" })
+        if isinstance(job.exception(), BrokenProcessPool) and pool is visualisation_executor:
+            info("Replacing broken visualisation pool")
+            start_visualisation_pool()
+
+
+# reads the training data for any training jobs that were
+#  accepted, but not started, before the server was last stopped
+#  blocks while the training data is parsed, so intended to be
+#   run in a thread, not on the event loop
+#  returns the jobs to resume, the queued models that can't be
+#   trained, and the models that were interrupted while training
+def read_recovered_jobs():
+    queued, interrupted = recover_jobs()
+    jobs = []
+    failed = []
+    for modelinfo, job in queued:
+        key = modelinfo["key"]
+        try:
+            with open(get_job_csv_location(key), "rb") as csvfile:
+                dataframe = read_training_data(key, csvfile)
+            fingerprint = get_fingerprint(dataframe, get_learner_options(dataframe))
+            datasize = get_data_size(dataframe)
+        except:
+            exception("%s : Failed to read training data for queued job", key)
+            fail_interrupted_model(modelinfo)
+            complete_job(key, job)
+            failed.append(modelinfo)
+            continue
+        jobs.append((modelinfo, dataframe, fingerprint, datasize, job))
+    return jobs, failed, interrupted
+
+
+# queue the training jobs read by read_recovered_jobs
+#  must be called from the event loop, as the models cache is
+#  updated with the status of the recovered models
+def resume_jobs(recovered: tuple):
+    jobs, failed, interrupted = recovered
+    for modelinfo in failed:
+        saved_models_cache[modelinfo["key"]] = modelinfo
+    for modelinfo in interrupted:
+        if modelinfo["key"] in saved_models_cache:
+            saved_models_cache[modelinfo["key"]] = modelinfo
+    for modelinfo, dataframe, fingerprint, datasize, job in jobs:
+        key = modelinfo["key"]
+        info("%s : Resuming training job", key)
+        saved_models_cache[key] = modelinfo
+        submit(modelinfo, dataframe, fingerprint, datasize, job)
@@ -0,0 +1,136 @@
+# core dependencies
+from logging import info, exception
+from os import getenv, mkdir, rename, walk, unlink, rmdir
+from os.path import exists, join, islink
+from pathlib import Path
+from threading import Thread, Event
+from time import sleep
+from uuid import uuid4
+# local dependencies
+from app.utils import recursive_delete, folder_size
+
+
+# initialising folder for files that are waiting to be deleted
+#  this needs to be on the same filesystem as the models, so
+#  that files can be moved into it without copying them
+if not exists("trash"):
+    info("Creating trash folder")
+    mkdir("trash")
+
+# maximum rate (bytes per second) that files are deleted at, so
+#  that deleting files doesn't compete with serving them
+deleterate = float(getenv("TRASH_DELETE_RATE_MB", "20")) * 1024 * 1024
+# seconds between checks for files to delete
+interval = float(getenv("TRASH_COLLECT_INTERVAL", "30"))
+
+# files waiting to be deleted, as of the last check, and the
+#  number of bytes deleted since the server was started
+stats = {
+    "pendingitems": 0,
+    "pendingbytes": 0,
+    "collectedbytes": 0
+}
+
+wakeup = Event()
+stopping = Event()
+collector = None
+
+
+def get_size(location: Path):
+    if location.is_symlink() or not location.is_dir():
+        return location.lstat().st_size
+    return folder_size(location)
+
+
+# removes a file or folder from where it is needed, so that
+#  it can be deleted later without slowing down the caller
+#  the files are counted as pending straight away, rather
+#  than at the next check by the collector
+def move_to_trash(location: Path):
+    if not location.exists() and not location.is_symlink():
+        return
+    trash_location = Path("trash", uuid4().hex)
+    try:
+        rename(location, trash_location)
+    except OSError:
+        exception("Failed to move %s to trash", location)
+        recursive_delete(location)
+    else:
+        stats["pendingitems"] += 1
+        stats["pendingbytes"] += get_size(trash_location)
+    wakeup.set()
+
+
+# records that a file has been deleted from the trash
+#  returns the number of seconds to wait before deleting the
+#   next file, to keep to the deleterate
+def collected(size: int) -> float:
+    stats["collectedbytes"] += size
+    stats["pendingbytes"] = max(stats["pendingbytes"] - size, 0)
+    if deleterate > 0:
+        return size / deleterate
+    return 0
+
+
+# deletes a file or folder from the trash, pausing between
+#  files so that deletes don't exceed the deleterate
+def delete_slowly(location: Path):
+    if location.is_symlink() or not location.is_dir():
+        size = location.lstat().st_size
+        location.unlink()
+        sleep(collected(size))
+        return
+
+    owed = 0
+    for root, dirs, filenames in walk(location, topdown=False):
+        for filename in filenames:
+            file_location = Path(root, filename)
+            size = file_location.lstat().st_size
+            file_location.unlink()
+            owed += collected(size)
+            if owed > 0.05:
+                sleep(owed)
+                owed = 0
+            if stopping.is_set():
+                return
+        for dirname in dirs:
+            dir_location = join(root, dirname)
+            if islink(dir_location):
+                unlink(dir_location)
+            else:
+                rmdir(dir_location)
+    rmdir(location)
+    sleep(owed)
+
+
+def collect():
+    while not stopping.is_set():
+        wakeup.clear()
+        pending = list(Path("trash").iterdir())
+        stats["pendingitems"] = len(pending)
+        stats["pendingbytes"] = sum(get_size(location) for location in pending)
+        if len(pending) > 0:
+            info("Deleting %d items (%d bytes) from trash", stats["pendingitems"], stats["pendingbytes"])
+        for location in pending:
+            if stopping.is_set():
+                return
+            try:
+                delete_slowly(location)
+            except:
+                exception("Failed to delete %s from trash", location)
+            stats["pendingitems"] -= 1
+        wakeup.wait(interval)
+
+
+def start_collector():
+    global collector
+    info("Starting trash collector")
+    stopping.clear()
+    collector = Thread(target=collect, name="trash-collector", daemon=True)
+    collector.start()
+
+
+def stop_collector():
+    info("Stopping trash collector")
+    stopping.set()
+    wakeup.set()
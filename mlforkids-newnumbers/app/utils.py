@@ -1,30 +1,72 @@
 # core dependencies
 from logging import debug
 from pathlib import Path
-from os import walk
-from os.path import basename, join
+from os import walk, replace, getpid
+from gzip import compress as gzip_compress
+from contextlib import contextmanager
 from datetime import datetime
-from zipfile import ZipFile, ZIP_DEFLATED
+# optional dependencies
+try:
+    from brotli import compress as brotli_compress
+except ImportError:
+    brotli_compress = None
+
+
+# precompressed copies of text files that are created for
+#  clients that accept them, in order of preference
+#  (filename extension, Content-Encoding)
+compressed_copies = [ (".br", "br"), (".gz", "gzip") ]
 
 
 def recursive_delete(location: Path):
     debug("recursive_delete %s", location)
-    if location.exists() and location.is_dir():
+    if location.is_symlink():
+        location.unlink()
+    elif location.exists() and location.is_dir():
         for path in location.iterdir():
-            if path.is_file():
+            if path.is_file() or path.is_symlink():
                 path.unlink()
             else:
                 recursive_delete(path)
         location.rmdir()
 
 
-def create_zip_flat(source_folder, zip_filename):
-    with ZipFile(zip_filename, 'w', ZIP_DEFLATED) as zipf:
-        for root, _, files in walk(source_folder):
-            for file in files:
-                file_path = join(root, file)
-                flat_path = basename(file_path)
-                zipf.write(file_path, flat_path)
+def folder_size(location: Path):
+    size = 0
+    for root, _, files in walk(location):
+        for file in files:
+            try:
+                size += Path(root, file).stat().st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+# writes a file so that anyone reading it will see either the
+#  previous contents or the new contents, never a partial file
+@contextmanager
+def replace_on_close(location: str, mode: str = "w"):
+    temporary = Path(location + "." + str(getpid()) + ".tmp")
+    try:
+        with open(temporary, mode) as openfile:
+            yield openfile
+        replace(temporary, location)
+    finally:
+        if temporary.exists():
+            temporary.unlink()
+
+
+# writes a file with precompressed copies, which are written
+#  first so that a copy is never older than the file
+def write_with_compressed_copies(location: str, contents: bytes):
+    with replace_on_close(location + ".gz", "wb") as gzipfile:
+        gzipfile.write(gzip_compress(contents, mtime=0))
+    if brotli_compress is not None:
+        with replace_on_close(location + ".br", "wb") as brotlifile:
+            brotlifile.write(brotli_compress(contents))
+    with replace_on_close(location, "wb") as openfile:
+        openfile.write(contents)
+
 
 def json_serializer(obj):
     if isinstance(obj, datetime):
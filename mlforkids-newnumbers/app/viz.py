@@ -1,21 +1,131 @@
 # core dependencies
 from logging import info, exception
 from io import BytesIO
-from os.path import join, exists
-from os import mkdir
-from json import dump
+from os.path import join, exists, realpath
+from os import mkdir, getenv, remove
+from json import dumps
 from threading import Lock
 # external dependencies
 from sklearn.tree import DecisionTreeClassifier, export_graphviz
-from sklearn.feature_extraction import DictVectorizer
 from pydotplus import graph_from_dot_data
-from pandas import DataFrame
+from pandas import DataFrame, Series, read_pickle, factorize, to_numeric
+from pandas.api.types import is_numeric_dtype, is_string_dtype
+from numpy import ndarray, float32, ones, arange, unique, where, isnan, argsort, array
+from scipy.sparse import csc_matrix, hstack
 # internal dependencies
-from app.utils import json_serializer
+from app.utils import json_serializer, write_with_compressed_copies
+from app.savedmodels import get_location, get_visualisation_data_location
+from app.preprocessing import find_sample
+from app.profiling import take_memory_checkpoint
 
 
 lock = Lock()
 
+# visualisations are not created for datasets larger than this
+#  (number of examples multiplied by the number of columns)
+maxcells = int(getenv("VISUALISATION_MAX_CELLS", "500000"))
+# visualisations of datasets with more examples than this are
+#  created from a sample, so that the tree stays small enough
+#  to read
+maxrows = int(getenv("VISUALISATION_MAX_ROWS", "2000"))
+
+# files created by a visualisation
+visualisation_files = [ "tree.svg", "tree.dot", "vocab.json" ]
+
+
+# keeps a copy of the training data so that a visualisation
+#  can be created if it is requested
+#  the data is kept with the staged model files until the
+#   model is published
+#  large datasets are sampled in the same way as for training
+#   (see app.preprocessing.find_sample)
+def save_visualisation_data(key: str, dataframe: DataFrame, staging_folder: str,
+                            labelcodes: ndarray, rowhashes: ndarray):
+    sample = find_sample(labelcodes, rowhashes, maxrows)
+    if sample is not None:
+        info("%s : Visualising a sample of %d examples", key, sample.sum())
+        dataframe = dataframe[sample]
+    if dataframe.size > maxcells:
+        info("%s : Dataset too large to visualise", key)
+        return
+    dataframe.to_pickle(join(staging_folder, "visualisation.pkl"))
+
+
+# creates the visualisation of a model from the training data
+#  kept by save_visualisation_data
+def create_deferred_visualisation(key: str, outcome_label: str):
+    data_location = get_visualisation_data_location(key)
+    if not exists(data_location):
+        return
+    dataframe = read_pickle(data_location)
+    take_memory_checkpoint()
+    # resolve the version of the model that is currently
+    #  published, in case it is replaced while this runs
+    create_visualisation(key, dataframe, outcome_label, realpath(join(get_location(key), "download")))
+    remove(data_location)
+
+# encodes a single column as one or more numeric columns
+#  returns a list of (feature name, first row) tuples and
+#  a sparse matrix with a column for each feature
+def encode_column(column: str, values: Series):
+    numrows = len(values)
+    if is_numeric_dtype(values.dtype):
+        return [ (column, 0) ], csc_matrix(values.to_numpy(dtype=float32, na_value=float("nan")).reshape(-1, 1))
+
+    # strings are one-hot encoded, with a feature for each value
+    if is_string_dtype(values.dtype) and values.dtype != object:
+        is_string = values.notna().to_numpy()
+    else:
+        is_string = values.map(lambda value: isinstance(value, str)).to_numpy(dtype=bool)
+    codes, uniques = factorize(values.where(is_string))
+    rows = arange(numrows)[is_string]
+    first_rows = rows[unique(codes[is_string], return_index=True)[1]]
+    features = [ (column + "=" + str(value), first) for value, first in zip(uniques, first_rows) ]
+    encoded = csc_matrix((ones(len(rows), dtype=float32), (rows, codes[is_string])),
+                         shape=(numrows, len(uniques)))
+
+    # anything else (numbers and missing values) is kept
+    #  in a numeric feature, as a DictVectorizer would
+    if not is_string.all():
+        first = int((~is_string).argmax())
+        numbers = to_numeric(values.mask(is_string), errors="coerce").to_numpy(dtype=float32, na_value=float("nan"))
+        numbers = where(is_string, 0, numbers).reshape(-1, 1)
+        features.append((column, first))
+        encoded = hstack([ encoded, csc_matrix(numbers) ], format="csc")
+
+    return features, encoded
+
+
+# encodes the features in the same way as a DictVectorizer,
+#  but a column at a time instead of creating a dict for
+#  every row
+#  returns the encoded features, the names of the encoded
+#   columns in sorted order (DictVectorizer.feature_names_)
+#   and in the order they first appear in the data
+#   (DictVectorizer.vocabulary_)
+def encode_features(features: DataFrame):
+    names = []
+    appearance = []
+    blocks = []
+    for position, column in enumerate(features.columns):
+        column_features, encoded = encode_column(column, features[column])
+        for name, first in column_features:
+            names.append(name)
+            appearance.append((first, position))
+        blocks.append(encoded)
+
+    vocab = [ names[index] for index in sorted(range(len(names)), key=lambda index: appearance[index]) ]
+    sorted_order = argsort(array(names, dtype=object), kind="stable")
+    feature_names = [ names[index] for index in sorted_order ]
+    encoded = hstack(blocks, format="csc")[:, sorted_order]
+
+    # sparse matrices can't be used for training a tree if
+    #  there are missing values, so these need a dense matrix
+    if isnan(encoded.data).any():
+        encoded = encoded.toarray()
+    return encoded, feature_names, vocab
+
+
 def create_visualisation(key: str, dataframe: DataFrame, outcome_label: str, download_folder: str):
     info("%s : Creating visualisation of a decision tree", key)
 
@@ -23,15 +133,17 @@ def create_visualisation(key: str, dataframe: DataFrame, outcome_label: str, dow
         target = dataframe[outcome_label]
 
         features = dataframe.drop(columns=[outcome_label])
-        vec = DictVectorizer(sparse=False)
-        features_dict = features.to_dict(orient="records")
-        features_encoded = vec.fit_transform(features_dict)
+        features_encoded, feature_names, vocab = encode_features(features)
+        # snapshots of memory for profiling are taken between
+        #  each stage, as they are while training
+        take_memory_checkpoint()
 
         tree = DecisionTreeClassifier()
         tree.fit(features_encoded, target)
+        take_memory_checkpoint()
 
         dot_data = export_graphviz(tree,
-                                   feature_names=vec.feature_names_,
+                                   feature_names=feature_names,
                                    class_names=tree.classes_,
                                    impurity=False,
                                    filled=True,
@@ -40,29 +152,28 @@ def create_visualisation(key: str, dataframe: DataFrame, outcome_label: str, dow
         with lock:
             graph = graph_from_dot_data(dot_data)
         graph.del_node("\"\\n\"")
+        take_memory_checkpoint()
 
         if not exists(download_folder):
             info("%s : Creating download folder", key)
             mkdir(download_folder)
 
 
-        with open(join(download_folder, "vocab.json"), "w") as vocabfile:
-            vocab = list(vec.vocabulary_)
-            dump(vocab, vocabfile, default=json_serializer)
-        with open(join(download_folder, "tree.svg"), "w") as svgfile:
-            svgbuffer = BytesIO()
-            graph.write_svg(svgbuffer)
-            svgbuffer.seek(0)
-            svg = svgbuffer.getvalue().decode().replace('\n', '')
-            del svgbuffer
-            svgfile.write(svg)
-        with open(join(download_folder, "tree.dot"), "w") as dotfile:
-            dotbuffer = BytesIO()
-            graph.write(dotbuffer)
-            dotbuffer.seek(0)
-            dot = dotbuffer.getvalue().decode()
-            del dotbuffer
-            dotfile.write(dot)
+        write_with_compressed_copies(join(download_folder, "vocab.json"),
+                                     dumps(vocab, default=json_serializer).encode())
+
+        svgbuffer = BytesIO()
+        graph.write_svg(svgbuffer)
+        svg = svgbuffer.getvalue().decode().replace('\n', '')
+        del svgbuffer
+        write_with_compressed_copies(join(download_folder, "tree.svg"), svg.encode())
+        take_memory_checkpoint()
+
+        dotbuffer = BytesIO()
+        graph.write(dotbuffer)
+        dot = dotbuffer.getvalue()
+        del dotbuffer
+        write_with_compressed_copies(join(download_folder, "tree.dot"), dot)
 
         info("%s : Visualisation complete", key)
     except:
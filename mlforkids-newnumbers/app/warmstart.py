@@ -0,0 +1,168 @@
+# core dependencies
+from logging import info
+from os import getenv, mkdir, rename
+from os.path import join, exists, isdir
+from pathlib import Path
+from json import dump, load
+# external dependencies
+from numpy import ndarray, save as save_array, load as load_array, isin
+from pandas import DataFrame
+from pandas.util import hash_pandas_object
+from pandas.api.types import is_numeric_dtype
+from ydf import GenericModel
+# local dependencies
+from app.savedmodels import get_working_location
+from app.utils import recursive_delete
+
+
+# number of boosting iterations added when updating a model
+warmstart_iterations = int(getenv("WARM_START_ITERATIONS", "20"))
+# maximum proportion of the previous training examples that
+#  can be added or removed for a model to be updated
+warmstart_churn = float(getenv("WARM_START_MAX_CHURN", "0.2"))
+# models are trained from scratch once they reach this size
+warmstart_max_iterations = int(getenv("WARM_START_MAX_ITERATIONS", "300"))
+
+
+# returns relative location of the training checkpoints for a project
+def get_warmstart_location(scratchkey: str):
+    return join(get_working_location(scratchkey), "warmstart")
+
+
+# describes the schema of a training dataset, so that it can be
+#  compared with the data used to train the previous model
+def describe_dataset(dataframe: DataFrame, outcome_label: str, classes: list) -> dict:
+    categories = {}
+    for column, dtype in dataframe.dtypes.items():
+        if column != outcome_label and not is_numeric_dtype(dtype):
+            categories[column] = sorted(str(value) for value in dataframe[column].dropna().unique())
+    return {
+        "columns": [ [ column, dtype.name ] for column, dtype in dataframe.dtypes.items() ],
+        "labels": classes,
+        "categories": categories
+    }
+
+
+# returns a hash for each of the training examples
+def hash_rows(dataframe: DataFrame) -> ndarray:
+    return hash_pandas_object(dataframe, index=False).values
+
+
+def get_latest_snapshot(checkpoints_folder: str):
+    snapshots_folder = Path(checkpoints_folder, "snapshot")
+    if not snapshots_folder.is_dir():
+        return None
+    iterations = [ int(snapshot.name.split("_")[-1]) for snapshot in snapshots_folder.iterdir()
+                   if snapshot.name.startswith("snapshot_") ]
+    return max(iterations, default=None)
+
+
+# replaces the latest snapshot with one of the model that was
+#  published, as early stopping (and the time budget) train
+#  trees past the ones that are kept in the model
+#  a snapshot is the tree files of a model, with the state of
+#   early stopping, in a model_N folder, and an empty
+#   snapshot/snapshot_N file, where N is the number of
+#   boosting iterations
+def trim_snapshot(scratchkey: str, checkpoints_folder: str, model: GenericModel, iterations: int):
+    latest = get_latest_snapshot(checkpoints_folder)
+    if latest is None or latest == iterations:
+        return
+    info("%s : Replacing snapshot after %d iterations with the published model", scratchkey, latest)
+    snapshot_folder = join(checkpoints_folder, "model_%d" % iterations)
+    model_folder = join(checkpoints_folder, "published")
+    model.save(model_folder)
+    mkdir(snapshot_folder)
+    for path in Path(model_folder).iterdir():
+        if path.name.startswith("gradient_boosted_trees_header") or path.name.startswith("nodes-"):
+            rename(path, join(snapshot_folder, path.name))
+    recursive_delete(Path(model_folder))
+    early_stopping = Path(checkpoints_folder, "model_%d" % latest, "early_stopping.pb")
+    if early_stopping.exists():
+        rename(early_stopping, join(snapshot_folder, early_stopping.name))
+    Path(checkpoints_folder, "snapshot", "snapshot_%d" % iterations).touch()
+
+
+# removes the snapshots other than the one for the published
+#  model, as YDF only resumes training from the latest snapshot
+def prune_snapshots(checkpoints_folder: str, iterations: int):
+    paths = list(Path(checkpoints_folder).glob("model_*")) + \
+            list(Path(checkpoints_folder, "snapshot").glob("snapshot_*"))
+    for path in paths:
+        if path.name.split("_")[-1] == str(iterations):
+            continue
+        if path.is_dir():
+            recursive_delete(path)
+        else:
+            path.unlink()
+
+
+# checks if the previous model for a project can be updated
+#  with new training data instead of training from scratch
+#  returns the previous description of the dataset and the
+#   number of boosting iterations that training can resume
+#   from, or None if a model needs to be trained from scratch
+def find_warmstart(scratchkey: str, dataset: dict, rowhashes: ndarray):
+    checkpoints_folder = get_warmstart_location(scratchkey)
+    description_location = join(checkpoints_folder, "dataset.json")
+    if not exists(description_location):
+        return None
+    with open(description_location) as descriptionfile:
+        previous = load(descriptionfile)
+
+    if previous["columns"] != dataset["columns"]:
+        info("%s : Columns have changed since the previous model", scratchkey)
+        return None
+    if previous.get("constant", []) != dataset["constant"]:
+        info("%s : Constant columns have changed since the previous model", scratchkey)
+        return None
+    if set(previous["labels"]) != set(dataset["labels"]):
+        info("%s : Labels have changed since the previous model", scratchkey)
+        return None
+    for column, values in dataset["categories"].items():
+        if not set(values).issubset(previous["categories"][column]):
+            info("%s : New values for %s since the previous model", scratchkey, column)
+            return None
+
+    previous_rows = load_array(join(checkpoints_folder, "rows.npy"))
+    removed = int((~isin(previous_rows, rowhashes)).sum())
+    added = int((~isin(rowhashes, previous_rows)).sum())
+    if removed + added > warmstart_churn * len(previous_rows):
+        info("%s : Too many changes since the previous model (%d added, %d removed)",
+             scratchkey, added, removed)
+        return None
+
+    # the latest snapshot must be the model that was published,
+    #  not trees that early stopping or the time budget left out
+    iterations = get_latest_snapshot(checkpoints_folder)
+    if iterations is None or iterations != previous.get("iterations"):
+        info("%s : No snapshot of the previous model", scratchkey)
+        return None
+    if iterations + warmstart_iterations > warmstart_max_iterations:
+        return None
+
+    info("%s : Updating previous model (%d added, %d removed)", scratchkey, added, removed)
+    return previous, iterations
+
+
+# removes the checkpoints from a previous model
+def clear_warmstart(scratchkey: str):
+    checkpoints_folder = get_warmstart_location(scratchkey)
+    recursive_delete(Path(checkpoints_folder))
+    working_folder = get_working_location(scratchkey)
+    if not isdir(working_folder):
+        mkdir(working_folder)
+    mkdir(checkpoints_folder)
+    return checkpoints_folder
+
+
+# records the data used to train a model, so that it can be
+#  compared with the data used for the next training request
+#  and keeps a snapshot of the model so that it can be updated
+def save_warmstart(scratchkey: str, dataset: dict, rowhashes: ndarray, model: GenericModel):
+    checkpoints_folder = get_warmstart_location(scratchkey)
+    trim_snapshot(scratchkey, checkpoints_folder, model, dataset["iterations"])
+    prune_snapshots(checkpoints_folder, dataset["iterations"])
+    with open(join(checkpoints_folder, "dataset.json"), "w") as descriptionfile:
+        dump(dataset, descriptionfile)
+    save_array(join(checkpoints_folder, "rows.npy"), rowhashes)
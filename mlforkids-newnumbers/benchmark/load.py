@@ -0,0 +1,467 @@
+#
+# Measures the throughput, latency and resource use of the API
+#  server while many clients train models at once and poll for
+#  the status of their models
+#
+# Starts the API server with uvicorn in a temporary folder, and
+#  replays the same workload for each dataset in turn:
+#   - the CSV files used by test/test-numbers.js
+#   - synthetic CSV files for each combination of --rows and
+#     --columns
+#
+# Settings for the server (such as TRAINING_WORKERS) are taken
+#  from the environment that the benchmark is run in.
+#
+# Run from the mlforkids-newnumbers folder:
+#   python -m benchmark.load
+#
+# Results are written to benchmark/results, or to --output, and
+#  can be compared with the results from a previous run:
+#   python -m benchmark.load --compare benchmark/results/<file>.json
+#
+
+# core dependencies
+from os import environ, listdir, getcwd, makedirs
+from os.path import join, abspath
+from sys import executable, version as python_version
+from platform import platform
+from subprocess import Popen, DEVNULL, run as run_command
+from tempfile import TemporaryDirectory
+from threading import Thread, Event, local
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from base64 import b64encode
+from statistics import quantiles
+from argparse import ArgumentParser
+from datetime import datetime
+from json import loads, dump, load
+from time import perf_counter, sleep
+from uuid import uuid4
+from math import inf
+from re import compile
+# external dependencies
+from numpy import where
+from numpy.random import default_rng
+from pandas import DataFrame
+
+
+datasets_folder = join("test", "data")
+results_folder = join("benchmark", "results")
+# test datasets that can't be used to train a model
+invalid_datasets = [ "singleclass.csv" ]
+
+# column that the API expects to contain the training labels
+outcome_label = "mlforkids_outcome_label"
+
+credentials = "Basic " + b64encode(b"benchmark:benchmark").decode()
+
+# percentiles reported for each latency
+percentiles = [ 50, 90, 99 ]
+
+
+# creates a CSV file with a mix of numeric and categorical
+#  columns, and a label that depends on some of them
+def create_csv(location: str, rows: int, columns: int):
+    rng = default_rng(0)
+    data = {}
+    for column in range(columns):
+        if column % 3 == 2:
+            data["category %d" % column] = rng.choice([ "red", "green", "blue", "yellow" ], size=rows)
+        else:
+            data["number %d" % column] = rng.normal(size=rows).round(3)
+    score = data["number 0"] + rng.normal(scale=0.5, size=rows)
+    data[outcome_label] = where(score > 0.5, "high", where(score < -0.5, "low", "medium"))
+    DataFrame(data).to_csv(location, index=False)
+
+
+# returns the (name, location) of each dataset to benchmark
+def get_datasets(folder: str, sweep: list):
+    datasets = [ (filename.removesuffix(".csv"), join(datasets_folder, filename))
+                 for filename in sorted(listdir(datasets_folder))
+                 if filename.endswith(".csv") and filename not in invalid_datasets ]
+    for rows, columns in sweep:
+        name = "synthetic-%dx%d" % (rows, columns)
+        location = join(folder, name + ".csv")
+        create_csv(location, rows, columns)
+        datasets.append((name, location))
+    return datasets
+
+
+#
+# running the API server
+#
+
+def start_server(folder: str, port: int):
+    env = dict(environ)
+    env.setdefault("PUBLIC_API_URL", "http://127.0.0.1:%d" % port)
+    env.setdefault("MODELS_CACHE_SIZE", "10000")
+    env.setdefault("MODELS_DISK_BUDGET_MB", "100000")
+    env["VERIFY_USER"] = "benchmark"
+    env["VERIFY_PASSWORD"] = "benchmark"
+    env["PYTHONPATH"] = getcwd()
+    server = Popen([ executable, "-m", "uvicorn", "app.main:app", "--port", str(port) ],
+                   cwd=folder, env=env, stdout=DEVNULL, stderr=DEVNULL)
+    for _ in range(600):
+        sleep(0.1)
+        if server.poll() is not None:
+            raise RuntimeError("API server stopped with exit code %d" % server.returncode)
+        try:
+            if request("GET", "/")[0] == 200:
+                return server
+        except OSError:
+            pass
+    server.terminate()
+    raise RuntimeError("API server did not start")
+
+
+# returns the ids of a process and all of its descendants
+def get_process_tree(pid: int):
+    pids = [ pid ]
+    for parent in pids:
+        try:
+            for task in listdir("/proc/%d/task" % parent):
+                with open("/proc/%d/task/%s/children" % (parent, task)) as children:
+                    pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return pids
+
+def get_rss(pid: int) -> int:
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+# samples the memory used by the server and its worker
+#  processes until stopped, recording the peak
+def sample_memory(pid: int, peak: dict, stopping: Event):
+    while not stopping.is_set():
+        peak["bytes"] = max(peak["bytes"], sum(get_rss(process) for process in get_process_tree(pid)))
+        stopping.wait(0.05)
+
+
+#
+# making requests to the API server
+#
+
+connections = local()
+port = 8000
+
+# returns the response status, body and the time taken
+def request(method: str, path: str, body: bytes = None, headers: dict = {}):
+    if getattr(connections, "connection", None) is None:
+        connections.connection = HTTPConnection("127.0.0.1", port, timeout=600)
+    request_start = perf_counter()
+    try:
+        connections.connection.request(method, path, body=body, headers=headers)
+        response = connections.connection.getresponse()
+        contents = response.read()
+    except OSError:
+        connections.connection.close()
+        connections.connection = None
+        raise
+    return response.status, contents, perf_counter() - request_start
+
+
+def encode_csv_upload(csvfile: bytes):
+    boundary = uuid4().hex
+    body = b"".join([
+        b"--" + boundary.encode() + b"\r\n",
+        b'Content-Disposition: form-data; name="csvfile"; filename="training.csv"\r\n',
+        b"Content-Type: text/csv\r\n\r\n",
+        csvfile,
+        b"\r\n--" + boundary.encode() + b"--\r\n"
+    ])
+    return body, "multipart/form-data; boundary=" + boundary
+
+
+# returns a copy of a CSV file with the rows in a different
+#  order for each client, so that each client trains a new
+#  model rather than reusing a model trained for another client
+def shuffle_csv(csvfile: bytes, client: int):
+    if client == 0:
+        return csvfile
+    header, _, rows = csvfile.partition(b"\n")
+    rows = rows.rstrip(b"\n").split(b"\n")
+    default_rng(client).shuffle(rows)
+    return header + b"\n" + b"\n".join(rows) + b"\n"
+
+
+# trains a model as a client would, submitting the training
+#  data and then polling for the status until training ends
+#  requests rejected because the server is busy are retried
+def run_client(csvfile: bytes, pollinterval: float, timeout: float):
+    key = "benchmark" + uuid4().hex
+    body, contenttype = encode_csv_upload(csvfile)
+    client_start = perf_counter()
+    result = { "rejections": 0, "polls": [] }
+    while True:
+        code, contents, result["submit"] = request("POST", "/model-requests/" + key, body, {
+            "Authorization": credentials,
+            "Content-Type": contenttype
+        })
+        if code != 503 or perf_counter() - client_start > timeout:
+            break
+        result["rejections"] += 1
+        sleep(1)
+    if code != 200:
+        result["status"] = "Rejected %d" % code
+        return result
+
+    modelinfo = loads(contents)
+    while modelinfo["status"] == "Training" and perf_counter() - client_start < timeout:
+        sleep(pollinterval)
+        code, contents, seconds = request("GET", "/models/%s/status" % key)
+        result["polls"].append(seconds)
+        if code != 200:
+            modelinfo = { "status": "Missing %d" % code }
+        else:
+            modelinfo = loads(contents)
+    result["ready"] = perf_counter() - client_start
+    result["status"] = modelinfo["status"]
+    result["training"] = modelinfo.get("training")
+    result["packaging"] = modelinfo.get("packaging")
+    return result
+
+
+#
+# collecting results
+#
+
+metric_pattern = compile(r'^([a-z_]+)(?:\{(.*)\})? (\S+)$')
+label_pattern = compile(r'([a-z_]+)="((?:[^"\\]|\\.)*)"')
+
+# returns the samples from the metrics endpoint
+#  keyed by (metric name, labels)
+def read_metrics():
+    code, contents, _ = request("GET", "/metrics")
+    samples = {}
+    for line in contents.decode().splitlines():
+        match = metric_pattern.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.groups()
+        samples[(name, tuple(label_pattern.findall(labels or "")))] = float(value)
+    return samples
+
+
+# estimates a quantile from the change in a histogram between
+#  two reads of the metrics, as Prometheus histogram_quantile
+def histogram_quantile(quantile: float, before: dict, after: dict, name: str, labels: tuple):
+    buckets = []
+    for (samplename, samplelabels), value in after.items():
+        if samplename != name + "_bucket" or samplelabels[:-1] != labels:
+            continue
+        bound = float(samplelabels[-1][1])
+        buckets.append((bound, value - before.get((samplename, samplelabels), 0)))
+    buckets.sort()
+    if len(buckets) == 0 or buckets[-1][1] == 0:
+        return None
+    rank = quantile * buckets[-1][1]
+    lower, previous = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == inf:
+                return lower
+            return lower + (bound - lower) * (rank - previous) / max(count - previous, 1)
+        lower, previous = bound, count
+    return lower
+
+
+def get_stage_latencies(before: dict, after: dict):
+    stages = {}
+    for name, labels in after:
+        if name != "mlforkids_training_stage_seconds_count":
+            continue
+        labels = dict(labels)
+        if labels["outcome"] != "Available":
+            continue
+        stagelabels = (("outcome", "Available"), ("stage", labels["stage"]))
+        stages[labels["stage"]] = {
+            "p%d" % percentile: histogram_quantile(percentile / 100, before, after,
+                                                   "mlforkids_training_stage_seconds", stagelabels)
+            for percentile in percentiles
+        }
+    return stages
+
+
+def summarise(values: list):
+    if len(values) == 0:
+        return None
+    summary = { "count": len(values), "max": max(values) }
+    if len(values) > 1:
+        cuts = quantiles(values, n=100, method="inclusive")
+        for percentile in percentiles:
+            summary["p%d" % percentile] = cuts[percentile - 1]
+    else:
+        for percentile in percentiles:
+            summary["p%d" % percentile] = values[0]
+    return summary
+
+
+def get_disk_usage(samples: dict):
+    return { dict(labels)["folder"]: value
+             for (name, labels), value in samples.items()
+             if name == "mlforkids_disk_bytes" }
+
+
+# runs the workload for a dataset, with a number of clients
+#  training models at the same time
+def run_workload(server: Popen, name: str, location: str, clients: int, pollinterval: float, timeout: float):
+    with open(location, "rb") as csvfile:
+        contents = csvfile.read()
+
+    metrics_before = read_metrics()
+    peak = { "bytes": 0 }
+    stopping = Event()
+    sampler = Thread(target=sample_memory, args=(server.pid, peak, stopping), daemon=True)
+    sampler.start()
+
+    workload_start = perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda client: run_client(shuffle_csv(contents, client), pollinterval, timeout),
+                                range(clients)))
+    duration = perf_counter() - workload_start
+
+    stopping.set()
+    sampler.join()
+    metrics_after = read_metrics()
+
+    outcomes = {}
+    for result in results:
+        outcomes[result["status"]] = outcomes.get(result["status"], 0) + 1
+    available = [ result for result in results if result["status"] == "Available" ]
+    polls = [ seconds for result in results for seconds in result["polls"] ]
+    return {
+        "dataset": name,
+        "bytes": len(contents),
+        "clients": clients,
+        "seconds": duration,
+        "outcomes": outcomes,
+        "rejections": sum(result["rejections"] for result in results),
+        "throughput": {
+            "models": len(available) / duration,
+            "polls": len(polls) / duration
+        },
+        "latency": {
+            "submit": summarise([ result["submit"] for result in results ]),
+            "poll": summarise(polls),
+            "ready": summarise([ result["ready"] for result in available ]),
+            "fit": summarise([ result["training"]["seconds"] for result in available
+                               if result.get("training") ]),
+            "package": summarise([ result["packaging"]["seconds"] for result in available
+                                   if result.get("packaging") ])
+        },
+        "stages": get_stage_latencies(metrics_before, metrics_after),
+        "peakrss": peak["bytes"],
+        "disk": get_disk_usage(metrics_after)
+    }
+
+
+def get_environment():
+    commit = run_command([ "git", "rev-parse", "HEAD" ], capture_output=True, text=True)
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "commit": commit.stdout.strip() if commit.returncode == 0 else None,
+        "python": python_version,
+        "platform": platform(),
+        "settings": { name: value for name, value in environ.items()
+                      if name.startswith(("TRAINING_", "MODEL", "CSV_", "PREDICT_", "VISUALISATION_")) }
+    }
+
+
+def print_results(workloads: list):
+    print("%-24s %8s %10s %10s %10s %10s %10s %10s" % ("dataset", "models/s", "submit p50", "poll p99",
+                                                       "ready p50", "ready p99", "fit p50", "peak MB"))
+    for workload in workloads:
+        latency = workload["latency"]
+        print("%-24s %8.2f %10s %10s %10s %10s %10s %10.1f" % (
+            workload["dataset"],
+            workload["throughput"]["models"],
+            format_seconds(latency["submit"], "p50"),
+            format_seconds(latency["poll"], "p99"),
+            format_seconds(latency["ready"], "p50"),
+            format_seconds(latency["ready"], "p99"),
+            format_seconds(latency["fit"], "p50"),
+            workload["peakrss"] / 1e6))
+
+def format_seconds(summary: dict, percentile: str):
+    if summary is None:
+        return "-"
+    return "%.3f" % summary[percentile]
+
+
+# prints the change in the main results since a previous run
+def print_comparison(workloads: list, previous: dict):
+    print()
+    print("Compared with %s (%s)" % (previous["environment"]["timestamp"], previous["environment"]["commit"]))
+    print("%-24s %12s %12s %12s" % ("dataset", "models/s", "ready p50", "peak RSS"))
+    previous_workloads = { workload["dataset"]: workload for workload in previous["workloads"] }
+    for workload in workloads:
+        before = previous_workloads.get(workload["dataset"])
+        if before is None or before["latency"]["ready"] is None or workload["latency"]["ready"] is None:
+            continue
+        print("%-24s %12s %12s %12s" % (
+            workload["dataset"],
+            format_change(before["throughput"]["models"], workload["throughput"]["models"]),
+            format_change(before["latency"]["ready"]["p50"], workload["latency"]["ready"]["p50"]),
+            format_change(before["peakrss"], workload["peakrss"])))
+
+def format_change(before: float, after: float):
+    if before == 0:
+        return "-"
+    return "%+.1f%%" % (100 * (after - before) / before)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the API server")
+    parser.add_argument("--clients", type=int, default=4, help="models trained at the same time")
+    parser.add_argument("--rows", type=int, nargs="*", default=[ 1000, 10000 ])
+    parser.add_argument("--columns", type=int, nargs="*", default=[ 10, 50 ])
+    parser.add_argument("--datasets", nargs="*", help="only run the workloads for these datasets")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between status requests")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for each model")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="file to write JSON results to")
+    parser.add_argument("--compare", help="JSON results from a previous run to compare with")
+    args = parser.parse_args()
+
+    port = args.port
+    with TemporaryDirectory() as folder:
+        datasets = get_datasets(folder, [ (rows, columns) for rows in args.rows for columns in args.columns ])
+        if args.datasets:
+            datasets = [ dataset for dataset in datasets if dataset[0] in args.datasets ]
+        datasets = [ (name, abspath(location)) for name, location in datasets ]
+
+        server = start_server(folder, port)
+        try:
+            workloads = []
+            for name, location in datasets:
+                print("Running workload for %s" % name)
+                workloads.append(run_workload(server, name, location,
+                                              args.clients, args.poll_interval, args.timeout))
+        finally:
+            server.terminate()
+            server.wait()
+
+    results = {
+        "environment": get_environment(),
+        "arguments": vars(args),
+        "workloads": workloads
+    }
+    print_results(workloads)
+    if args.compare:
+        with open(args.compare) as previousfile:
+            print_comparison(workloads, load(previousfile))
+    output = args.output
+    if output is None:
+        makedirs(results_folder, exist_ok=True)
+        output = join(results_folder, "load-%s.json" % datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with open(output, "w") as outputfile:
+        dump(results, outputfile, indent=2)
+    print("Results written to %s" % output)
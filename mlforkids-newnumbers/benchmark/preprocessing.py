@@ -0,0 +1,181 @@
+#
+# Compares the memory and time used to train a model from the
+#  training data as it is read from a CSV file, and after it has
+#  been compacted by app.preprocessing (factorized labels,
+#  downcast numbers, categorical text, no constant columns)
+#
+# Each measurement is made in a new process, so that memory
+#  freed by one measurement isn't reused by the next. Memory is
+#  the size of the dataframe given to YDF, and the growth in the
+#  peak RSS of the process while the model is trained.
+#
+# Run from the mlforkids-newnumbers folder:
+#   python -m benchmark.preprocessing
+#
+
+# core dependencies
+from os import listdir, makedirs
+from os.path import join
+from tempfile import TemporaryDirectory
+from multiprocessing import get_context
+from time import perf_counter
+from argparse import ArgumentParser
+from datetime import datetime
+from json import dump
+# external dependencies
+from numpy import abs as absolute
+from numpy.random import default_rng
+from pandas import DataFrame, read_csv, concat
+from ydf import GradientBoostedTreesLearner, verbose
+# local dependencies
+from app.preprocessing import factorize_labels, find_constant_columns, compact_features
+from app.memory import track_memory
+
+
+datasets_folder = join("test", "data")
+results_folder = join("benchmark", "results")
+# test datasets that can't be used to train a model
+invalid_datasets = [ "singleclass.csv" ]
+
+outcome_label = "mlforkids_outcome_label"
+
+# number of examples used to compare the predictions of the models
+comparisonrows = 1000
+
+
+# creates a CSV file with a mix of integer, decimal, text and
+#  constant columns, and a label that depends on some of them
+def create_csv(location: str, rows: int, columns: int):
+    rng = default_rng(0)
+    data = {}
+    for column in range(columns):
+        if column % 4 == 0:
+            data["number %d" % column] = rng.normal(size=rows).round(3)
+        elif column % 4 == 1:
+            data["count %d" % column] = rng.integers(0, 100, size=rows)
+        elif column % 4 == 2:
+            data["colour %d" % column] = rng.choice([ "red", "green", "blue", "yellow" ], size=rows)
+        else:
+            data["constant %d" % column] = "same"
+    score = data["number 0"] + rng.normal(scale=0.5, size=rows)
+    data[outcome_label] = [ "high" if value > 0.5 else "low" if value < -0.5 else "medium" for value in score ]
+    DataFrame(data).to_csv(location, index=False)
+
+
+# creates a larger copy of a test dataset, as they are too
+#  small to show differences in memory
+def scale_csv(source: str, location: str, scale: int):
+    dataframe = read_csv(source)
+    concat([ dataframe ] * scale, ignore_index=True).to_csv(location, index=False)
+
+
+def get_datasets(folder: str, scale: int, sweep: list):
+    datasets = []
+    for filename in sorted(listdir(datasets_folder)):
+        if filename.endswith(".csv") and filename not in invalid_datasets:
+            name = filename.removesuffix(".csv")
+            location = join(folder, filename)
+            scale_csv(join(datasets_folder, filename), location, scale)
+            datasets.append((name, location))
+    for rows, columns in sweep:
+        name = "synthetic-%dx%d" % (rows, columns)
+        location = join(folder, name + ".csv")
+        create_csv(location, rows, columns)
+        datasets.append((name, location))
+    return datasets
+
+
+# prepares training data in the way that app.models did before
+#  the training data was compacted
+def prepare_original(dataframe: DataFrame):
+    dataframe[outcome_label] = dataframe[outcome_label].astype(str)
+    classes = list(dataframe[outcome_label].unique())
+    dataframe[outcome_label] = dataframe[outcome_label].map(classes.index)
+
+
+def prepare_compact(dataframe: DataFrame):
+    dataframe[outcome_label] = dataframe[outcome_label].astype(str)
+    labelcodes, _ = factorize_labels(dataframe[outcome_label])
+    constant = find_constant_columns(dataframe, outcome_label)
+    dataframe[outcome_label] = labelcodes
+    compact_features("benchmark", dataframe, outcome_label, constant)
+
+
+preparations = {
+    "original": prepare_original,
+    "compact": prepare_compact
+}
+
+
+# run in a new process for each measurement
+def measure(location: str, preparation: str, trees: int):
+    verbose(0)
+    dataframe = read_csv(location)
+    examples = dataframe.drop(columns=[ outcome_label ]).head(comparisonrows)
+
+    started = perf_counter()
+    preparations[preparation](dataframe)
+    preparesecs = perf_counter() - started
+    databytes = int(dataframe.memory_usage(index=False, deep=True).sum())
+
+    learner = GradientBoostedTreesLearner(label=outcome_label, num_trees=trees, num_threads=1)
+    started = perf_counter()
+    model, fitbytes = track_memory(learner.train, dataframe)
+    fitsecs = perf_counter() - started
+
+    return {
+        "preparesecs": preparesecs,
+        "databytes": databytes,
+        "fitsecs": fitsecs,
+        "fitbytes": fitbytes
+    }, model.predict(examples)
+
+
+def measure_in_process(location: str, preparation: str, trees: int):
+    with get_context("spawn").Pool(1) as pool:
+        return pool.apply(measure, (location, preparation, trees))
+
+
+def run(datasets: list, trees: int):
+    results = []
+    print("%-24s %8s %12s %12s %12s %12s %10s" % ("dataset", "rows", "data MB", "fit MB",
+                                                 "fit secs", "prep secs", "max diff"))
+    for name, location in datasets:
+        rows = len(read_csv(location, usecols=[ outcome_label ]))
+        result = { "dataset": name, "rows": rows }
+        predictions = {}
+        for preparation in preparations:
+            result[preparation], predictions[preparation] = measure_in_process(location, preparation, trees)
+        result["maxdifference"] = float(absolute(predictions["original"] - predictions["compact"]).max())
+        results.append(result)
+        for preparation in preparations:
+            measurements = result[preparation]
+            print("%-24s %8d %12.2f %12.2f %12.3f %12.3f %10s" % (
+                name + " (" + preparation + ")", rows,
+                measurements["databytes"] / 1e6, (measurements["fitbytes"] or 0) / 1e6,
+                measurements["fitsecs"], measurements["preparesecs"],
+                "%.4f" % result["maxdifference"] if preparation == "compact" else ""))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark compacting training data")
+    parser.add_argument("--scale", type=int, default=50, help="copies of each test dataset")
+    parser.add_argument("--rows", type=int, nargs="*", default=[ 10000, 100000 ])
+    parser.add_argument("--columns", type=int, nargs="*", default=[ 20, 100 ])
+    parser.add_argument("--trees", type=int, default=50)
+    parser.add_argument("--output", help="file to write JSON results to")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as folder:
+        datasets = get_datasets(folder, args.scale,
+                                [ (rows, columns) for rows in args.rows for columns in args.columns ])
+        results = run(datasets, args.trees)
+
+    output = args.output
+    if output is None:
+        makedirs(results_folder, exist_ok=True)
+        output = join(results_folder, "preprocessing-%s.json" % datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with open(output, "w") as outputfile:
+        dump({ "arguments": vars(args), "results": results }, outputfile, indent=2)
+    print("Results written to %s" % output)
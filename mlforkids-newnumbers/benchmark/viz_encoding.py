@@ -0,0 +1,92 @@
+#
+# Compares the time and memory used to encode training data
+#  for the decision tree visualisation, using a DictVectorizer
+#  (one dict per row, dense one-hot matrix) and the columnar
+#  encoding used by app.viz.encode_features
+#
+# Run from the mlforkids-newnumbers folder:
+#   python -m benchmark.viz_encoding
+#
+
+# core dependencies
+from os import environ
+from time import perf_counter
+from tracemalloc import start, stop, get_traced_memory, reset_peak
+from argparse import ArgumentParser
+from json import dump
+# external dependencies
+from numpy.random import default_rng
+from pandas import DataFrame
+from sklearn.feature_extraction import DictVectorizer
+
+# app modules expect the same environment as the API server
+environ.setdefault("PUBLIC_API_URL", "http://localhost:8000")
+environ.setdefault("MODELS_CACHE_SIZE", "100")
+# local dependencies
+from app.viz import encode_features
+
+
+# creates a dataset with a mix of numeric and categorical columns
+def create_dataset(rows: int, columns: int, cardinality: int) -> DataFrame:
+    rng = default_rng(0)
+    data = {}
+    for column in range(columns):
+        if column % 4 == 0:
+            data["number %d" % column] = rng.normal(size=rows)
+        else:
+            values = [ "value %d" % value for value in range(cardinality) ]
+            data["category %d" % column] = rng.choice(values, size=rows)
+    return DataFrame(data)
+
+
+def encode_with_dictvectorizer(features: DataFrame):
+    vec = DictVectorizer(sparse=False)
+    encoded = vec.fit_transform(features.to_dict(orient="records"))
+    return encoded, vec.feature_names_, list(vec.vocabulary_)
+
+
+# returns the time taken (seconds) and peak memory (bytes)
+def measure(encoder, features: DataFrame):
+    start()
+    reset_peak()
+    before, _ = get_traced_memory()
+    started = perf_counter()
+    result = encoder(features)
+    duration = perf_counter() - started
+    _, peak = get_traced_memory()
+    stop()
+    return result, duration, peak - before
+
+
+def run(sweep):
+    results = []
+    print("%8s %8s %12s %12s %12s %12s %8s" % ("rows", "columns", "dict secs", "column secs",
+                                               "dict MB", "column MB", "same"))
+    for rows, columns, cardinality in sweep:
+        features = create_dataset(rows, columns, cardinality)
+        (_, _, dict_vocab), dict_secs, dict_bytes = measure(encode_with_dictvectorizer, features)
+        (_, _, column_vocab), column_secs, column_bytes = measure(encode_features, features)
+        same = dict_vocab == column_vocab
+        results.append({
+            "rows": rows, "columns": columns, "cardinality": cardinality,
+            "dictvectorizer": { "seconds": dict_secs, "peakbytes": dict_bytes },
+            "columnar": { "seconds": column_secs, "peakbytes": column_bytes },
+            "identicalvocab": same
+        })
+        print("%8d %8d %12.3f %12.3f %12.1f %12.1f %8s" % (rows, columns, dict_secs, column_secs,
+                                                           dict_bytes / 1e6, column_bytes / 1e6, same))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark visualisation encodings")
+    parser.add_argument("--rows", type=int, nargs="+", default=[ 1000, 10000 ])
+    parser.add_argument("--columns", type=int, nargs="+", default=[ 10, 50, 200 ])
+    parser.add_argument("--cardinality", type=int, default=20)
+    parser.add_argument("--output", help="file to write JSON results to")
+    args = parser.parse_args()
+
+    results = run([ (rows, columns, args.cardinality) for rows in args.rows for columns in args.columns ])
+    if args.output:
+        with open(args.output, "w") as outputfile:
+            dump(results, outputfile, indent=2)
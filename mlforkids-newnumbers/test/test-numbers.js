@@ -67,10 +67,54 @@ describe('verify new number service API', () => {
 
     describe('healthcheck', () => {
 
+        function waitForReady() {
+            return request(API + '/ready', DEFAULT_REQUEST)
+                .catch((err) => {
+                    assert.strictEqual(err.statusCode, 503);
+                    assert.notStrictEqual(err.error.startup.status, 'Failed');
+                    return pause().then(waitForReady);
+                });
+        }
+
+        it('should be live while the server is starting', () => {
+            return request(API + '/live', DEFAULT_REQUEST)
+                .then((resp) => {
+                    assert.deepStrictEqual(resp, { live : true });
+                });
+        });
+
+        it('should report when the server is ready', () => {
+            return waitForReady()
+                .then((resp) => {
+                    assert.strictEqual(resp.ready, true);
+                    assert.strictEqual(resp.startup.status, 'Ready');
+                    assert(resp.startup.seconds > 0);
+                    assert.strictEqual(typeof resp.queue.training, 'number');
+                    assert.strictEqual(typeof resp.queue.waiting, 'number');
+                    assert(resp.queue.capacity > 0);
+                });
+        });
+
         it('should have an unauthenticated healthcheck API', () => {
             return request(API, DEFAULT_REQUEST)
                 .then((resp) => {
-                    assert.deepStrictEqual({ ok : true }, resp);
+                    assert.strictEqual(resp.ok, true);
+                    assert.strictEqual(resp.startup.status, 'Ready');
+                    assert(resp.memory.budget > 0);
+                    assert.strictEqual(typeof resp.memory.reserved, 'number');
+                    assert.strictEqual(typeof resp.memory.waiting, 'number');
+                    assert(resp.memory.estimator.factor >= 1);
+                });
+        });
+
+        it('should have an unauthenticated metrics API', () => {
+            return request(API + '/metrics', { resolveWithFullResponse : true })
+                .then((resp) => {
+                    assert(resp.headers['content-type'].startsWith('text/plain; version=0.0.4'));
+                    assert(resp.body.includes('# TYPE mlforkids_training_jobs_inflight gauge'));
+                    assert(resp.body.includes('# TYPE mlforkids_training_jobs_running gauge'));
+                    assert(resp.body.includes('mlforkids_disk_bytes{folder="saved-models"}'));
+                    assert(resp.body.includes('mlforkids_http_request_duration_seconds_count{method="GET",route="/",status="200"}'));
                 });
         });
 
@@ -138,10 +182,11 @@ describe('verify new number service API', () => {
             return request.post(NEW_MODEL_API + key, trainingRequest)
                 .then((resp) => {
                     assert.strictEqual(typeof (new Date(resp.lastupdate)).getSeconds(), 'number');
-                    delete resp.lastupdate;
-                    assert.deepStrictEqual(resp, {
+                    // models trained with identical data by a previous
+                    //  test run are reused without training again
+                    assert([ 'Training', 'Available' ].includes(resp.status));
+                    assert.deepStrictEqual({ key : resp.key, urls : resp.urls }, {
                         key,
-                        status : 'Training',
                         urls : {
                             status : API + '/saved-models/' + key + '/status',
                             model : API + '/saved-models/' + key + '/download/model.zip',
@@ -185,6 +230,130 @@ describe('verify new number service API', () => {
                 });
         });
 
+        it('should update the previous model when a few examples are added', () => {
+            const key = newScratchKey();
+            // leave out a random selection of examples from both
+            //  requests, so that neither model is reused from the
+            //  model store, with half of them added back for the
+            //  second request
+            const lines = fs.readFileSync(TITANIC, { encoding: 'utf-8' }).trim().split('\n');
+            const header = lines.shift();
+            const missing = new Set();
+            while (missing.size < 10) {
+                missing.add(Math.floor(Math.random() * lines.length));
+            }
+            const stillMissing = new Set([ ...missing ].slice(0, 5));
+            function csvfile(examples) {
+                return {
+                    value : [ header, ...examples ].join('\n'),
+                    options : {
+                        filename : 'training.csv',
+                        contentType : 'text/csv'
+                    }
+                };
+            }
+            let trees;
+            return request.post(NEW_MODEL_API + key, {
+                    ...DEFAULT_REQUEST,
+                    ...DEV_CREDENTIALS,
+                    formData : {
+                        csvfile : csvfile(lines.filter((line, idx) => !missing.has(idx)))
+                    },
+                })
+                .then((resp) => {
+                    return waitForModel(resp.urls.status);
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.status, 'Available');
+                    assert.strictEqual(resp.training.mode, 'Full');
+                    trees = resp.training.trees;
+                    return request.post(NEW_MODEL_API + key, {
+                        ...DEFAULT_REQUEST,
+                        ...DEV_CREDENTIALS,
+                        formData : {
+                            csvfile : csvfile(lines.filter((line, idx) => !stillMissing.has(idx)))
+                        },
+                    });
+                })
+                .then((resp) => {
+                    return waitForModel(resp.urls.status);
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.status, 'Available');
+                    assert.strictEqual(resp.training.mode, 'Incremental');
+                    // trees are added to the model that was published,
+                    //  not to the trees that early stopping left out
+                    assert(resp.training.trees > trees);
+                    assert(resp.training.trees <= trees + 20);
+                });
+        });
+
+        it('should replace a model that is still training with a newer request', () => {
+            const key = newScratchKey();
+            return request.post(NEW_MODEL_API + key, {
+                    ...DEFAULT_REQUEST,
+                    ...DEV_CREDENTIALS,
+                    formData : {
+                        csvfile : fs.createReadStream(PHISHING)
+                    },
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.status, 'Training');
+                    return request.post(NEW_MODEL_API + key, {
+                        ...DEFAULT_REQUEST,
+                        ...DEV_CREDENTIALS,
+                        formData : {
+                            csvfile : fs.createReadStream(TITANIC)
+                        },
+                    });
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.status, 'Training');
+                    return waitForModel(resp.urls.status);
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.status, 'Available');
+                    assert.deepStrictEqual(resp.labels.sort(), [ 'died', 'survived' ]);
+                });
+        });
+
+        it('should reuse models trained with identical data', () => {
+            const firstKey = newScratchKey();
+            const secondKey = newScratchKey();
+            return request.post(NEW_MODEL_API + firstKey, {
+                    ...DEFAULT_REQUEST,
+                    ...DEV_CREDENTIALS,
+                    formData : {
+                        csvfile : fs.createReadStream(POKEMON)
+                    },
+                })
+                .then((resp) => {
+                    return waitForModel(resp.urls.status);
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.status, 'Available');
+                    return request.post(NEW_MODEL_API + secondKey, {
+                        ...DEFAULT_REQUEST,
+                        ...DEV_CREDENTIALS,
+                        formData : {
+                            csvfile : fs.createReadStream(POKEMON)
+                        },
+                    });
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.key, secondKey);
+                    assert.strictEqual(resp.status, 'Available');
+                    assert.deepStrictEqual(resp.labels, [ 'water', 'fairy', 'rock', 'fire', 'electric', 'steel' ]);
+                    return request.get(resp.urls.model, { encoding : null });
+                })
+                .then((resp) => {
+                    return ydf.loadModelFromZipBlob(resp);
+                })
+                .then((model) => {
+                    return model.unload();
+                });
+        });
+
         it('should be possible to submit requests without a file', () => {
             const key = newScratchKey();
             const csvData = fs.readFileSync(PHISHING, { encoding: 'utf-8' });
@@ -204,10 +373,11 @@ describe('verify new number service API', () => {
             return request.post(NEW_MODEL_API + key, trainingRequest)
                 .then((resp) => {
                     assert.strictEqual(typeof (new Date(resp.lastupdate)).getSeconds(), 'number');
-                    delete resp.lastupdate;
-                    assert.deepStrictEqual(resp, {
+                    // models trained with identical data by a previous
+                    //  test run are reused without training again
+                    assert([ 'Training', 'Available' ].includes(resp.status));
+                    assert.deepStrictEqual({ key : resp.key, urls : resp.urls }, {
                         key,
-                        status : 'Training',
                         urls : {
                             status : API + '/saved-models/' + key + '/status',
                             model : API + '/saved-models/' + key + '/download/model.zip',
@@ -314,6 +484,93 @@ describe('verify new number service API', () => {
         it('should handle running multiple models at once', () => {
             return Promise.all([run(PHISHING), run(POKEMON), run(TITANIC)]);
         });
+
+        it('should wait for training to finish', () => {
+            const key = newScratchKey();
+            const statusUrl = API + '/models/' + key + '/status';
+            let etag;
+
+            return request.post(NEW_MODEL_API + key, {
+                    ...DEFAULT_REQUEST,
+                    ...DEV_CREDENTIALS,
+                    formData : {
+                        csvfile : fs.createReadStream(TITANIC)
+                    },
+                })
+                .then(() => {
+                    return request.get(statusUrl + '?wait=30', { ...DEFAULT_REQUEST, resolveWithFullResponse : true });
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.body.status, 'Available');
+                    etag = resp.headers.etag;
+                    assert(etag);
+                    return request.get(statusUrl + '?wait=1', {
+                        ...DEFAULT_REQUEST,
+                        headers : { 'If-None-Match' : etag },
+                        simple : false,
+                        resolveWithFullResponse : true
+                    });
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.statusCode, 304);
+                    assert.strictEqual(resp.headers.etag, etag);
+                });
+        });
+
+        it('should return the status of many models at once', () => {
+            const key = newScratchKey();
+            const unknownKey = newScratchKey();
+
+            return request.post(NEW_MODEL_API + key, {
+                    ...DEFAULT_REQUEST,
+                    ...DEV_CREDENTIALS,
+                    formData : {
+                        csvfile : fs.createReadStream(POKEMON)
+                    },
+                })
+                .then(() => {
+                    return request.post(API + '/model-statuses', {
+                        ...DEFAULT_REQUEST,
+                        ...DEV_CREDENTIALS,
+                        body : { keys : [ key, unknownKey ] }
+                    });
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp[key].key, key);
+                    assert([ 'Training', 'Available' ].includes(resp[key].status));
+                    assert.deepStrictEqual(resp[unknownKey], { key : unknownKey, status : 'Unavailable' });
+                });
+        });
+
+        it('should return 404 for the status of unknown models', () => {
+            return request.get(API + '/models/' + newScratchKey() + '/status', DEFAULT_REQUEST)
+                .then(() => {
+                    assert.fail('should not have returned a status');
+                })
+                .catch((err) => {
+                    assert.strictEqual(err.statusCode, 404);
+                });
+        });
+
+        it('should require credentials to get profiles of training jobs', () => {
+            return request.get(API + '/models/' + newScratchKey() + '/profiles', DEFAULT_REQUEST)
+                .then(() => {
+                    assert.fail('should not have returned profiles');
+                })
+                .catch((err) => {
+                    assert.strictEqual(err.statusCode, 401);
+                });
+        });
+
+        it('should return 404 for profiles of unknown models', () => {
+            return request.get(API + '/models/' + newScratchKey() + '/profiles', { ...DEFAULT_REQUEST, ...DEV_CREDENTIALS })
+                .then(() => {
+                    assert.fail('should not have returned profiles');
+                })
+                .catch((err) => {
+                    assert.strictEqual(err.statusCode, 404);
+                });
+        });
     });
 
 
@@ -414,6 +671,86 @@ describe('verify new number service API', () => {
 
 
 
+    describe('predictions', () => {
+
+        it('should classify a batch of examples', () => {
+            const key = newScratchKey();
+            const trainingRequest = {
+                ...DEFAULT_REQUEST,
+                ...DEV_CREDENTIALS,
+                formData : {
+                    csvfile : fs.createReadStream(TITANIC)
+                },
+            };
+
+            return request.post(NEW_MODEL_API + key, trainingRequest)
+                .then((resp) => {
+                    return waitForModel(resp.urls.status);
+                })
+                .then(() => {
+                    return request.post(API + '/models/' + key + '/predict', {
+                        ...DEFAULT_REQUEST,
+                        body : [
+                            { 'ticket class' : 1, 'gender' : 'female', 'age' : 29, 'sibl. sp.' : 0, 'par. ch.' : 0, 'ticket fare' : 211.34, 'embarked' : 'Southampt' },
+                            { 'ticket class' : 3, 'gender' : 'male', 'age' : 30, 'sibl. sp.' : 0, 'par. ch.' : 0, 'ticket fare' : 7.9, 'embarked' : 'Southampt' },
+                            { 'ticket class' : 2, 'gender' : null, 'age' : null, 'sibl. sp.' : 0, 'par. ch.' : 0, 'ticket fare' : 13, 'embarked' : null },
+                        ],
+                    });
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.length, 3);
+                    for (const ranked of resp) {
+                        assert.strictEqual(ranked.length, 2);
+                        assert.deepStrictEqual(ranked.map((r) => r.class_name).sort(), [ 'died', 'survived' ]);
+                        assert(ranked[0].confidence >= ranked[1].confidence);
+                    }
+                });
+        });
+
+        it('should classify examples in a CSV file', () => {
+            const key = newScratchKey();
+            const trainingRequest = {
+                ...DEFAULT_REQUEST,
+                ...DEV_CREDENTIALS,
+                formData : {
+                    csvfile : fs.createReadStream(POKEMON)
+                },
+            };
+
+            return request.post(NEW_MODEL_API + key, trainingRequest)
+                .then((resp) => {
+                    return waitForModel(resp.urls.status);
+                })
+                .then(() => {
+                    return request.post(API + '/models/' + key + '/predict', {
+                        body : fs.readFileSync(POKEMON),
+                        headers : { 'Content-Type' : 'text/csv' },
+                        json : false,
+                    });
+                })
+                .then((resp) => {
+                    const predictions = JSON.parse(resp);
+                    assert.strictEqual(predictions.length, 350);
+                    assert.strictEqual(predictions[0].length, 6);
+                });
+        });
+
+        it('should reject predictions for unknown models', () => {
+            return request.post(API + '/models/' + newScratchKey() + '/predict', {
+                    ...DEFAULT_REQUEST,
+                    body : [ { 'height' : 1 } ],
+                })
+                .then(() => {
+                    assert.fail('should not have accepted the request');
+                })
+                .catch((err) => {
+                    assert.strictEqual(err.statusCode, 404);
+                });
+        });
+    });
+
+
+
     describe('model metadata', () => {
 
         it('should return metadata about titanic data', () => {
@@ -468,6 +805,14 @@ describe('verify new number service API', () => {
                             "name": "mlforkids_outcome_label"
                         }
                     });
+                    assert.strictEqual(typeof modelinfo.packaging.seconds, 'number');
+                    assert.strictEqual(modelinfo.sampling.rows, 712);
+                    assert.strictEqual(modelinfo.sampling.sampled, 712);
+                    assert(modelinfo.sampling.accuracy > 0 && modelinfo.sampling.accuracy <= 1);
+                    return request.get(modelUrl, { encoding : null })
+                        .then((zip) => {
+                            assert.strictEqual(modelinfo.packaging.bytes, zip.length);
+                        });
                 });
         });
 
@@ -819,5 +1164,43 @@ describe('verify new number service API', () => {
                     model.unload();
                 });
         });
+
+        it('should allow versioned downloads to be cached', () => {
+            const key = newScratchKey();
+            let status;
+
+            return request.post(NEW_MODEL_API + key, {
+                    ...DEFAULT_REQUEST,
+                    ...DEV_CREDENTIALS,
+                    formData : {
+                        csvfile : fs.createReadStream(POKEMON)
+                    },
+                })
+                .then((resp) => {
+                    return waitForModel(resp.urls.status);
+                })
+                .then((resp) => {
+                    status = resp;
+                    assert(status.version);
+                    return request.get(API + '/saved-models/' + key + '/' + status.version + '/model.zip', {
+                        encoding : null,
+                        resolveWithFullResponse : true
+                    });
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.headers['cache-control'], 'public, max-age=31536000, immutable');
+                    assert.strictEqual(resp.headers.etag, '"' + status.version + '-model.zip"');
+                    return request.get(status.urls.model, {
+                        encoding : null,
+                        headers : { 'If-None-Match' : resp.headers.etag },
+                        simple : false,
+                        resolveWithFullResponse : true
+                    });
+                })
+                .then((resp) => {
+                    assert.strictEqual(resp.statusCode, 304);
+                    assert.strictEqual(resp.headers['cache-control'], 'no-cache');
+                });
+        });
     });
 });
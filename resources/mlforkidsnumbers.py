@@ -7,7 +7,8 @@ from os.path import join, exists
 from shutil import rmtree
 from json import load, loads
 from zipfile import ZipFile
-from pandas import DataFrame
+from pandas import DataFrame, to_numeric
+from numpy import asarray, column_stack, argsort, take_along_axis
 from ydf import load_model
 
 
@@ -31,6 +32,8 @@ class MLforKidsNumbers:
             self._message("Accessing model metadata...")
             self.METADATA = self._read_json_file(join(model_folder, "mlforkids.json"))
             self._message("Model trained at " + self.METADATA["lastupdate"])
+
+            self._prepare_feature_mapping()
         else:
             self.MODEL = None
 
@@ -150,6 +153,41 @@ class MLforKidsNumbers:
 
 
 
+    # ------------------------------------------------------------
+    #  Identify the names and types the model uses for each feature
+    # ------------------------------------------------------------
+
+    def _prepare_feature_mapping(self):
+        self._FEATURE_NAMES = {}
+        self._NUMERIC_FEATURES = set()
+        for feature in self.METADATA["features"]:
+            label = self.METADATA["features"][feature]["name"]
+            type = self.METADATA["features"][feature]["type"]
+            if label != "mlforkids_outcome_label":
+                self._FEATURE_NAMES[feature] = label
+                if type in [ "int64", "float64", "int32", "float32", "bool" ]:
+                    self._NUMERIC_FEATURES.add(feature)
+        self._LABELS = asarray(self.METADATA["labels"])
+
+
+    # ------------------------------------------------------------
+    #  Prepare data using the names and types the model was
+    #  trained with
+    # ------------------------------------------------------------
+
+    def _prepare_dataframe(self, dataframe):
+        prepared = {}
+        for feature, label in self._FEATURE_NAMES.items():
+            if not feature in dataframe.columns:
+                raise Exception("Missing required value " + feature)
+            if feature in self._NUMERIC_FEATURES:
+                prepared[label] = to_numeric(dataframe[feature], errors="coerce")
+            else:
+                prepared[label] = dataframe[feature].astype(str).fillna("")
+        return DataFrame(prepared)
+
+
+
     def _sort_by_confidence (self, e):
         return e["confidence"]
 
@@ -189,19 +227,10 @@ class MLforKidsNumbers:
             self._message("Train a new model on the Machine Learning for Kids site, then try again with the new URL.")
             raise Exception ("Model unavailable")
 
-        labelled = {}
-        types = {}
-        for feature in self.METADATA["features"]:
-            label = self.METADATA["features"][feature]["name"]
-            type = self.METADATA["features"][feature]["type"]
-            if label == "mlforkids_outcome_label":
-                continue
+        for feature in self._FEATURE_NAMES:
             if not feature in data:
                 raise Exception("Missing required value " + feature)
-            labelled[label] = data[feature]
-            if type != "object":
-                types[label] = type
-        df = DataFrame([ labelled ])
+        df = self._prepare_dataframe(DataFrame([ { feature: data[feature] for feature in self._FEATURE_NAMES } ]))
         classifications = self.MODEL.predict(df)
         results = []
         if len(self.METADATA["labels"]) == 2:
@@ -225,3 +254,38 @@ class MLforKidsNumbers:
         results.sort(reverse=True, key=self._sort_by_confidence)
         return results
 
+
+
+    # use the model to classify a table of data
+    #  returns two arrays, each with a row for every example
+    #   the labels sorted by confidence, and the confidence
+    #   percentages in the same order
+    def classify_dataframe(self, dataframe):
+        if self.MODEL is None:
+            self._message("Train a new model on the Machine Learning for Kids site, then try again with the new URL.")
+            raise Exception ("Model unavailable")
+
+        df = self._prepare_dataframe(dataframe)
+
+        classifications = self.MODEL.predict(df)
+        if len(self._LABELS) == 2:
+            classifications = column_stack([ 1 - classifications, classifications ])
+
+        confidences = (classifications * 100).astype(int)
+        order = argsort(-confidences, axis=1, kind="stable")
+        return self._LABELS[order], take_along_axis(confidences, order, axis=1)
+
+
+
+    # use the model to classify a list of data
+    #  returns a sorted list of objects for each item in the
+    #  list, in the same format as the classify function
+    def classify_batch(self, data):
+        if not isinstance(data, DataFrame):
+            data = DataFrame(list(data))
+        labels, confidences = self.classify_dataframe(data)
+        return (
+            [ { "class_name" : class_name, "confidence" : confidence }
+                for class_name, confidence in zip(row_labels, row_confidences) ]
+            for row_labels, row_confidences in zip(labels.tolist(), confidences.tolist())
+        )